@@ -1,4 +1,8 @@
-import random
+import os
+import time
+import threading
+import concurrent.futures
+
 import numpy
 
 import dash_daq as daq
@@ -7,275 +11,741 @@ import dash_core_components as dcc
 
 try:
     import seabreeze.spectrometers as sb
-    from seabreeze.spectrometers import SeaBreezeError
 except Exception as e:
     print(e)
 
+from acquisition import (AcquisitionThread, FrameDeliveryTracker,
+                         FrameRingBuffer)
+from averaging import SpectrumAverager
+from exposure import AutoExposure
+from peaks import PeakTracker
+from health import DeviceHealth
+from recording import RecordingReader, SpectrumRecorder
+from synthetic import SyntheticSpectrum
+from waterfall import NO_ROWS, WaterfallHistory
+from worker import (CoalescingQueue, DeviceWorker, PRIORITY_ACQUISITION,
+                    PRIORITY_LIGHT, PRIORITY_SETTINGS)
+
+
+# shortest time between two light intensity changes sent to a light
+# source (s)
+LIGHT_INTENSITY_INTERVAL = 0.05
+
+# a device thread stuck in a read is replaced at most this many times in
+# a row without a spectrum being read in between, waiting at least
+# WORKER_RESTART_BACKOFF seconds before the first replacement and twice
+# as long before each further one
+MAX_WORKER_RESTARTS = 5
+WORKER_RESTART_BACKOFF = 10.0
+
+# controls applied to acquired spectra rather than sent to the device
+HOST_CONTROLS = ('averaging-mode-input', 'averaging-frames-input',
+                 'boxcar-width-input', 'auto-exposure-input',
+                 'exposure-target-input')
+
+
+# properties of a connected spectrometer that do not change while it
+# stays connected, so they are read from the device only once
+class DeviceInfo:
+    def __init__(self, model='', serial='', pixels=0, wavelengths=None,
+                 lightSources=None, intTimeMin=1000, intTimeMax=650000000,
+                 maxIntensity=None):
+        self.model = model                  # model name for graph title
+        self.serial = serial                # serial number
+        self.pixels = pixels                # number of pixels
+        self.wavelengths = wavelengths      # wavelength calibration (nm)
+        self.light_sources = ([] if lightSources is None
+                              else lightSources)  # dropdown options
+        self.int_time_min = intTimeMin      # minimum integration time (us)
+        self.int_time_max = intTimeMax      # maximum integration time (us)
+        self.max_intensity = maxIntensity   # saturation level (counts)
+
 
 # abstract base class to represent spectrometers
+#
+# all communication with the device happens on a single DeviceWorker
+# thread; subclasses implement the device methods (prefixed with an
+# underscore), which are only ever called on that thread and so need no
+# locking, and the public methods queue them with a priority
+#
+# no call waits on the device for ever: commands give up after
+# commandTimeout seconds, and reads after readTimeout seconds more than
+# the exposure takes (None waits for as long as the read takes); every
+# read, failed command and reconnection is counted in a DeviceHealth
 class DashOceanOpticsSpectrometer:
 
-    def __init__(self, specLock, commLock):
+    def __init__(self, commandTimeout=10, readTimeout=10):
         self._spec = None                 # spectrometer
-        self._specmodel = ''              # model name for graph title
-        self._lightSources = {}           # dict of light sources, if any
+        self._device_info = None          # cached properties of the device
         self._spectralData = [[], []]     # wavelengths and intensities
-        self._controlFunctions = {}       # behaviour upon changing controls
-        self._int_time_max = 650000000    # maximum integration time (ms)
-        self._int_time_min = 1000         # minimum integration time (ms)
-        self.comm_lock = commLock         # for communicating with spectrometer
-        self.spec_lock = specLock         # for editing spectrometer values
+        self._controlFunctions = {}       # control id -> (function, type)
+        self._command_timeout = commandTimeout  # max wait for the device (s)
+        self._read_timeout = readTimeout  # max wait beyond the exposure (s)
+        self._health = DeviceHealth()     # how reads and commands are going
+        self._settings = {}               # control values last applied
+        self._worker = DeviceWorker()     # owns all device communication
+        self._worker_lock = threading.Lock()  # guards replacing it
+        self._abandoned = []              # replaced threads, still stuck
+        self._restarts = 0                # replacements since the last read
+        self._next_restart = 0.0          # when one is allowed again
+        self._frames = None               # recent frames from acquisition
+        self._acquisition = None          # background acquisition thread
+        self._recorder = None             # records frames to disk if set
+        self._waterfall = None            # WaterfallHistory, once started
+        self._peak_tracker = None         # PeakTracker, once started
+        self._delivered = FrameDeliveryTracker()  # last sent to each client
+        self._averager = SpectrumAverager()  # host-side averaging
+        self._auto_exposure = None        # sets the integration time if set
+        self._host_values = {             # values of the HOST_CONTROLS
+            'averaging-mode-input': 'none',
+            'averaging-frames-input': 10,
+            'boxcar-width-input': 1,
+            'auto-exposure-input': False,
+            'exposure-target-input': 80
+        }
+        self._light_queue = CoalescingQueue(  # pending light intensities
+            self._apply_light_intensity, LIGHT_INTENSITY_INTERVAL,
+            name='spectrometer-light')
+        self._worker.start()
+        self._light_queue.start()
 
-    # refreshes/populates spectrometer properties
-    def assign_spec(self):
+    # device methods; only called on the device thread
+
+    # connects to the spectrometer and populates the cached device
+    # properties; does nothing if already connected
+    def _assign_spec(self):
+        return
+
+    # forget the connected device, e.g. after it has been unplugged
+    def _disconnect(self):
+        self._device_info = None
+        self._settings = {}
+
+    # forget the device without talking to it, because the device thread
+    # is stuck in a call to it; the new device thread opens it again;
+    # returns what _release needs to close it
+    def _abandon(self):
+        spec = self._spec
+        self._spec = None
+        self._device_info = None
+        self._settings = {}
+        return spec
+
+    # close what _abandon returned; called on the abandoned device thread
+    # once its stuck call has returned, if it ever does
+    def _release(self, spec):
         return
 
-    # get data for graph
+    # read one spectrum from the device; None if nothing could be read,
+    # or raises with the reason
+    def _read_spectrum(self):
+        return None
+
+    # send each command, all in one go on the device thread, through
+    # _controlFunctions, which maps each control id to the function that
+    # applies it and the type its value is converted to first (None to
+    # pass it as it is); returns failures, successes and how long each
+    # command took (s)
+    def _send_control_values(self, commands):
+        failed = {}
+        succeeded = {}
+        timings = {}
+
+        for ctrl_id, value in commands.items():
+            start = time.perf_counter()
+            try:
+                if ctrl_id not in self._controlFunctions:
+                    raise Exception("Unknown control.")
+                function, convert = self._controlFunctions[ctrl_id]
+                function(value if convert is None else convert(value))
+                succeeded[ctrl_id] = str(value)
+            except Exception as e:
+                failed[ctrl_id] = str(e).strip('b')
+            timings[ctrl_id] = time.perf_counter() - start
+
+        return (failed, succeeded, timings)
+
+    # live-update light intensity
+    def _send_light_intensity(self, lightSource, intensity):
+        return
+
+    # public methods; these queue work for the device thread
+
+    def assign_spec(self):
+        self._device_call(PRIORITY_SETTINGS, self._assign_spec)
+
+    # the next access connects again
+    def disconnect(self):
+        self._device_call(PRIORITY_SETTINGS, self._disconnect)
+
+    # cached properties of the device, connecting first if necessary;
+    # None if no device is connected, and the reason is in health()
+    def device_info(self):
+        if self._device_info is None:
+            try:
+                self.assign_spec()
+            except concurrent.futures.TimeoutError:
+                self._health.failure('timed out connecting to the device')
+            except Exception as e:
+                self._health.failure(e)
+        return self._device_info
+
+    # how long a read may take before the device is given up on (s), or
+    # None to wait for as long as it takes
+    def _read_deadline(self):
+        if self._read_timeout is None:
+            return None
+        settings = self._settings
+        try:
+            exposure = (
+                float(settings.get('integration-time-input', 0)) / 1e6 *
+                max(int(settings.get('nscans-to-average-input', 1)), 1))
+        except (TypeError, ValueError):
+            exposure = 0.0
+        return exposure + self._read_timeout
+
+    # used by the acquisition thread; never raises, and returns None if
+    # no spectrum could be read, with the reason recorded in health()
+    #
+    # a read that misses its deadline has left the device thread stuck in
+    # a call that may never return; that thread is left behind and a new
+    # one takes over, reopening the device on the next read
+    def read_spectrum(self):
+        worker = self._worker
+        try:
+            spectrum = worker.call(PRIORITY_ACQUISITION,
+                                   self._read_deadline(),
+                                   self._read_spectrum)
+        except concurrent.futures.TimeoutError:
+            self._health.failure('timed out reading a spectrum')
+            self._replace_worker(worker)
+            return None
+        except Exception as e:
+            self._health.failure(e)
+            return None
+        if spectrum is None:
+            self._health.failure('no spectrum available')
+        else:
+            self._health.success()
+            self._restarts = 0
+        return spectrum
+
+    # replace the stuck device thread, unless it has been replaced too
+    # often or too recently (see MAX_WORKER_RESTARTS); until then reads
+    # keep being queued for it, in case its call returns after all
+    def _replace_worker(self, stuck):
+        with self._worker_lock:
+            # another caller got here first
+            if self._worker is not stuck:
+                return
+            now = time.time()
+            if self._restarts >= MAX_WORKER_RESTARTS or \
+               now < self._next_restart:
+                return
+            handle = self._abandon()
+            worker = DeviceWorker()
+            worker.start()
+            self._worker = worker
+            self._restarts += 1
+            self._next_restart = now + (WORKER_RESTART_BACKOFF *
+                                        2 ** (self._restarts - 1))
+            self._abandoned = [t for t in self._abandoned
+                               if t.is_alive()] + [stuck]
+            self._health.worker_restart()
+        # it stops once its call returns, without running queued work, and
+        # then closes the device handle it was using
+        stuck.stop(0, self._release, handle)
+
+    # read, connection and command failures, and when the last spectrum
+    # was read; a dict made by DeviceHealth.snapshot, plus how many
+    # replaced device threads are still stuck and whether replacing them
+    # has been given up (until a spectrum is read again)
+    def health(self):
+        health = self._health.snapshot()
+        health['stuck_threads'] = sum(1 for t in self._abandoned
+                                      if t.is_alive())
+        health['restarts_exhausted'] = self._restarts >= MAX_WORKER_RESTARTS
+        return health
+
+    # get data for graph; the newest acquired frame if acquisition is
+    # running in the background, otherwise read directly from the device
     def get_spectrum(self):
+        if self.acquiring():
+            frame = self.latest_frame()
+            if frame is not None:
+                self._spectralData = [frame.wavelengths, frame.intensities]
+            return self._spectralData
+
+        spectrum = self.read_spectrum()
+        if spectrum is not None:
+            self._spectralData = spectrum
         return self._spectralData
 
-    # send each command; return successes and failures
+    # settings jump ahead of any queued reads; values that are the same as
+    # the ones last applied are not sent again, the averaging and exposure
+    # controls are applied here rather than by the device, and everything
+    # else goes to the device in one batch; returns failures, successes
+    # (including unchanged values) and the time each command took (s),
+    # which is None for unchanged values
     def send_control_values(self, commands):
-        return ({}, {})
+        unchanged = {ctrl_id: value for ctrl_id, value in commands.items()
+                     if ctrl_id in self._settings and
+                     self._settings[ctrl_id] == value}
+        changed = {ctrl_id: value for ctrl_id, value in commands.items()
+                   if ctrl_id not in unchanged}
+
+        start = time.perf_counter()
+        failed, succeeded, device_commands = \
+            self._apply_host_controls(changed)
+        host_time = time.perf_counter() - start
+        timings = {ctrl_id: host_time for ctrl_id in changed
+                   if ctrl_id not in device_commands}
+        timings.update({ctrl_id: None for ctrl_id in unchanged})
+
+        if len(device_commands) > 0:
+            try:
+                device_failed, device_succeeded, device_timings = \
+                    self._device_call(PRIORITY_SETTINGS,
+                                      self._send_control_values,
+                                      device_commands)
+            except concurrent.futures.TimeoutError:
+                self._health.command_failure(
+                    'timed out waiting for the spectrometer')
+                device_failed = {
+                    ctrl_id: 'timed out waiting for the spectrometer'
+                    for ctrl_id in device_commands}
+                device_succeeded = {}
+                device_timings = {ctrl_id: self._command_timeout
+                                  for ctrl_id in device_commands}
+            failed.update(device_failed)
+            succeeded.update(device_succeeded)
+            timings.update(device_timings)
+
+        # replaced rather than updated, so that frames can keep a
+        # reference to the settings they were taken with
+        if len(succeeded) > 0:
+            settings = dict(self._settings)
+            settings.update({ctrl_id: commands[ctrl_id]
+                             for ctrl_id in succeeded})
+            self._settings = settings
+        succeeded.update({ctrl_id: str(value)
+                          for ctrl_id, value in unchanged.items()})
+        return (failed, succeeded, timings)
+
+    # control values last applied successfully; must not be modified
+    def settings(self):
+        return self._settings
+
+    # applies the controls in HOST_CONTROLS; returns failures, successes
+    # and the commands that are left for the device
+    def _apply_host_controls(self, commands):
+        host = {ctrl_id: commands[ctrl_id] for ctrl_id in HOST_CONTROLS
+                if ctrl_id in commands}
+        remaining = {ctrl_id: value for ctrl_id, value in commands.items()
+                     if ctrl_id not in host}
+        if len(host) == 0:
+            return ({}, {}, remaining)
+
+        values = dict(self._host_values, **host)
+        try:
+            averager = SpectrumAverager(
+                values['averaging-mode-input'],
+                values['averaging-frames-input'],
+                values['boxcar-width-input']
+            )
+            auto_exposure = None
+            if values['auto-exposure-input']:
+                auto_exposure = AutoExposure(
+                    float(values['exposure-target-input']) / 100)
+            self._averager = averager
+            self._auto_exposure = auto_exposure
+            self._host_values = values
+        except (TypeError, ValueError) as e:
+            return ({ctrl_id: str(e) for ctrl_id in host}, {}, remaining)
+        return ({}, {ctrl_id: str(value) for ctrl_id, value in host.items()},
+                remaining)
+
+    # averaged copy of a newly read spectrum; called by the acquisition
+    # thread
+    def process_spectrum(self, intensities):
+        return self._averager.add(intensities, self._settings)
+
+    # called by the acquisition thread with every frame it has published,
+    # before it reads the next one; with auto exposure on, this is where
+    # the integration time is changed
+    def frame_published(self, frame):
+        auto_exposure = self._auto_exposure
+        if auto_exposure is None:
+            return
+        settings = frame.settings or {}
+        current = float(settings.get('integration-time-input',
+                                     self.int_time_min()))
+        new = auto_exposure.next_integration_time(
+            frame, current, self.saturation_level(),
+            (self.int_time_min(), self.int_time_max()))
+        if new is not None:
+            self.send_control_values({'integration-time-input': new})
+
+    # returns at once; only the latest intensity of each light source is
+    # kept, and applied at most once every LIGHT_INTENSITY_INTERVAL
+    def send_light_intensity(self, lightSource, intensity):
+        self._light_queue.put(lightSource, intensity)
+
+    # nobody waits for the result, so a failure is only recorded
+    def _apply_light_intensity(self, lightSource, intensity):
+        try:
+            self._device_call(PRIORITY_LIGHT, self._send_light_intensity,
+                              lightSource, intensity)
+        except concurrent.futures.TimeoutError:
+            self._health.command_failure(
+                'timed out setting the light intensity')
+        except Exception as e:
+            self._health.command_failure(e)
+
+    # run func on the device thread, giving up after the command timeout
+    def _device_call(self, priority, func, *args):
+        return self._worker.call(priority, self._command_timeout,
+                                 func, *args)
+
+    # start reading spectra continuously into a ring buffer of the
+    # given size; intensities are stored as dtype if given
+    def start_acquisition(self, bufferSize, dtype=None):
+        if self.acquiring():
+            return
+        self._frames = FrameRingBuffer(bufferSize, dtype)
+        self._acquisition = AcquisitionThread(self, self._frames)
+        self._acquisition.start()
+
+    def stop_acquisition(self):
+        self.stop_recording()
+        if self._acquisition is not None:
+            self._acquisition.stop()
+            self._acquisition = None
+
+    def acquiring(self):
+        return (self._acquisition is not None and
+                self._acquisition.is_alive())
+
+    # newest frame shared by all clients, or None if none is available;
+    # reading it keeps the background acquisition running
+    def latest_frame(self):
+        if self._frames is None:
+            return None
+        self._frames.touch()
+        return self._frames.latest()
+
+    # block until a frame newer than seq has been acquired; returns it, or
+    # None after timeout seconds
+    def wait_for_frame(self, seq, timeout=None):
+        if self._frames is None:
+            return None
+        self._frames.touch()
+        return self._frames.wait_for_frame(seq, timeout)
+
+    # typical time (s) between recently acquired frames, or None if it is
+    # not known yet
+    def frame_period(self):
+        if self._frames is None:
+            return None
+        return self._frames.frame_period()
+
+    # what each client was last sent, so that identical updates can be
+    # skipped; every process serving clients must see the same record,
+    # or one would skip an update because of what it sent before another
+    # process sent something else
+    def delivery_tracker(self):
+        return self._delivered
+
+    # buffered frames, oldest first
+    def frames(self):
+        if self._frames is None:
+            return []
+        return self._frames.frames()
+
+    # append every acquired frame to a recording in directory until
+    # stop_recording is called; acquisition does not pause while
+    # recording, and a new chunk of the recording is started every
+    # chunkFrames frames or chunkSeconds seconds
+    def start_recording(self, directory, chunkFrames=1000,
+                        chunkSeconds=None):
+        if self._acquisition is None:
+            raise Exception("Acquisition is not running.")
+        self.stop_recording()
+        self._recorder = SpectrumRecorder(directory, chunkFrames,
+                                          chunkSeconds)
+        self._acquisition.add_listener(self._recorder.record)
+
+    def stop_recording(self):
+        recorder, self._recorder = self._recorder, None
+        if recorder is None:
+            return
+        if self._acquisition is not None:
+            self._acquisition.remove_listener(recorder.record)
+        recorder.close()
+
+    # directory and number of frames of the current recording, or None
+    def recording_status(self):
+        recorder = self._recorder
+        return None if recorder is None else recorder.status()
+
+    # keep a waterfall history (see waterfall.py) of every acquired frame;
+    # it does not keep acquisition running by itself, and starting it
+    # again does nothing
+    def start_waterfall(self, rows, columns, rowPeriod):
+        if self._acquisition is None:
+            raise Exception("Acquisition is not running.")
+        if self._waterfall is not None:
+            return
+        self._waterfall = WaterfallHistory(rows, columns, rowPeriod)
+        self._acquisition.add_listener(self._waterfall.add,
+                                       keepRunning=False)
+
+    # see WaterfallHistory.rows
+    def waterfall_rows(self, after=None):
+        waterfall = self._waterfall
+        return NO_ROWS if waterfall is None else waterfall.rows(after)
+
+    def waterfall_generation(self):
+        waterfall = self._waterfall
+        return NO_ROWS[0] if waterfall is None else waterfall.generation()
+
+    # follow the given wavelength bands (see PeakTracker) in every
+    # acquired frame, like the waterfall
+    def start_peak_tracking(self, bands, history):
+        if self._acquisition is None:
+            raise Exception("Acquisition is not running.")
+        if self._peak_tracker is not None:
+            return
+        self._peak_tracker = PeakTracker(bands, history)
+        self._acquisition.add_listener(self._peak_tracker.add,
+                                       keepRunning=False)
+
+    # see PeakTracker.series
+    def band_series(self, since=None):
+        tracker = self._peak_tracker
+        if tracker is None:
+            return numpy.empty(0), {}
+        return tracker.series(since)
+
+    # see PeakTracker.latest
+    def latest_bands(self):
+        tracker = self._peak_tracker
+        return None if tracker is None else tracker.latest()
+
+    # getter methods; these only read the cached device properties
 
-    # live-update light intensity
-    def send_light_intensity(self, val):
-        return
-    
-    # getter methods
-    
     def model(self):
-        return self._specmodel
+        return self._info().model
+
+    def serial(self):
+        return self._info().serial
 
     def light_sources(self):
-        return self._lightSources
+        return self._info().light_sources
 
     def int_time_max(self):
-        return self._int_time_max
+        return self._info().int_time_max
 
     def int_time_min(self):
-        return self._int_time_min
-    
-    
+        return self._info().int_time_min
+
+    # counts at which the detector saturates; None if unknown
+    def saturation_level(self):
+        return self._info().max_intensity
+
+    # device properties, or defaults if no device is connected
+    def _info(self):
+        info = self.device_info()
+        return info if info is not None else DeviceInfo()
+
+
 # non-demo version
 class PhysicalSpectrometer(DashOceanOpticsSpectrometer):
     
-    def __init__(self, specLock, commLock):
-        super().__init__(specLock, commLock)
-        try:
-            self.spec_lock.acquire()
-            self.assign_spec()
-        except SeaBreezeError:  # if the spec has already been connected
-            pass
-        finally:
-            self.spec_lock.release()
+    def __init__(self, commandTimeout=10, readTimeout=10):
+        super().__init__(commandTimeout, readTimeout)
+        self.device_info()
+        # the device may be reopened, so self._spec is looked up each time
         self._controlFunctions = {
             'integration-time-input':
-            "self._spec.integration_time_micros",
+            (lambda x: self._spec.integration_time_micros(x), int),
 
             'nscans-to-average-input':
-            "self._spec.scans_to_average",
+            (lambda x: self._spec.scans_to_average(x), int),
 
             'continuous-strobe-toggle-input':
-            "self._spec.continuous_strobe_set_enable",
+            (lambda x: self._spec.continuous_strobe_set_enable(x), bool),
 
             'continuous-strobe-period-input':
-            "self._spec.continuous_strobe_set_period_micros",
+            (lambda x: self._spec.continuous_strobe_set_period_micros(x),
+             int),
 
             'light-source-input':
-            "self.update_light_source"
+            (self.update_light_source, None)
         }
 
-    def assign_spec(self):
+    def _assign_spec(self):
+        if self._device_info is not None:
+            return
+        self._health.reconnect_attempt()
+        devices = sb.list_devices()
+        if len(devices) == 0:
+            raise Exception("No spectrometer found.")
+        spec = sb.Spectrometer(devices[0])
         try:
-            self.comm_lock.acquire()
-            devices = sb.list_devices()
-            self._spec = sb.Spectrometer(devices[0])
-            self._specmodel = self._spec.model
-            self._lightSources = [{'label': ls.__repr__(), 'value': ls}
-                                  for ls in list(self._spec.light_sources())]
-            self._int_time_min = self._spec.minimum_integration_time_micros()
+            self._device_info = self._read_device_info(spec)
+        except Exception:
+            # left open, it could not be opened again on the next attempt
+            spec.close()
+            raise
+        self._spec = spec
+
+    # queries everything DeviceInfo holds from a newly opened device; only
+    # the wavelengths are required, and the optional properties that a
+    # device or seabreeze version does not support keep their defaults
+    def _read_device_info(self, spec):
+        wavelengths = spec.wavelengths()
+        defaults = DeviceInfo()
+        int_time_min = defaults.int_time_min
+        int_time_max = defaults.int_time_max
+        try:
+            # newer versions of seabreeze report both limits
+            int_time_min, int_time_max = spec.integration_time_micros_limits
         except Exception:
-            pass
-        finally:
-            self.comm_lock.release()
-
-    def get_spectrum(self):
-        if self._spec is None:
             try:
-                self.spec_lock.acquire()
-                self.assign_spec()
+                int_time_min = spec.minimum_integration_time_micros()
             except Exception:
                 pass
-            finally:
-                self.spec_lock.release()
         try:
-            self.comm_lock.acquire()
-            self._spectralData = self._spec.spectrum(correct_dark_counts=True,
-                                                     correct_nonlinearity=True)
+            light_sources = [{'label': ls.__repr__(), 'value': ls}
+                             for ls in list(spec.light_sources())]
         except Exception:
-            pass
-        finally:
-            self.comm_lock.release()
-
-        return self._spectralData
-
-    def send_control_values(self, commands):
-        failed = {}
-        succeeded = {}
-        
-        for ctrl_id in commands:
-            try:
-                self.comm_lock.acquire()
-                eval(self._controlFunctions[ctrl_id])(commands[ctrl_id])
-                succeeded[ctrl_id] = str(commands[ctrl_id])
-            except Exception as e:
-                failed[ctrl_id] = str(e).strip('b')
-            finally:
-                self.comm_lock.release()
-                
-        return(failed, succeeded)
-
-    def send_light_intensity(self, lightSource, intensity):
+            light_sources = []
         try:
-            self.comm_lock.acquire()
-            lightSource.set_intensity(intensity)
+            max_intensity = spec.max_intensity
         except Exception:
-            pass
-        finally:
-            self.comm_lock.release()
-            
-    def model(self):
-        try:
-            self.spec_lock.acquire()
-            self.assign_spec()
-        except SeaBreezeError:
-            pass
-        finally:
-            self.spec_lock.release()
-        return self._specmodel
+            max_intensity = None
+        return DeviceInfo(
+            model=spec.model,
+            serial=spec.serial_number,
+            pixels=len(wavelengths),
+            wavelengths=wavelengths,
+            lightSources=light_sources,
+            intTimeMin=int_time_min,
+            intTimeMax=int_time_max,
+            maxIntensity=max_intensity
+        )
 
-    def light_sources(self):
+    def _disconnect(self):
         try:
-            self.spec_lock.acquire()
-            self.assign_spec()
-        except SeaBreezeError:
-            pass
+            if self._spec is not None:
+                self._spec.close()
+        except Exception as e:
+            # e.g. it has been unplugged; forgotten all the same
+            self._health.command_failure(e)
         finally:
-            self.spec_lock.release()
-            
-        return self._lightSources
+            self._spec = None
+            self._device_info = None
+            # a reopened device starts with its default settings
+            self._settings = {}
 
-    def int_time_max(self):
+    def _release(self, spec):
         try:
-            self.spec_lock.acquire()
-            self.assign_spec()
-        except SeaBreezeError:
-            pass
-        finally:
-            self.spec_lock.release()
-            
-        return self._int_time_max
-
-    def int_time_min(self):
+            if spec is not None:
+                spec.close()
+        except Exception as e:
+            self._health.command_failure(e)
+
+    # only the intensities are read; the wavelength calibration is cached
+    # with the device properties
+    def _read_spectrum(self):
+        self._assign_spec()
+        spec = self._spec
+        info = self._device_info
         try:
-            self.spec_lock.acquire()
-            self.assign_spec()
-        except SeaBreezeError:
-            pass
-        finally:
-            self.spec_lock.release()
+            intensities = spec.intensities(correct_dark_counts=True,
+                                           correct_nonlinearity=True)
+            return [info.wavelengths, intensities]
+        except Exception:
+            # the device may have been unplugged; reconnect on the next
+            # read, unless this thread was abandoned while the read hung
+            # and the device has been opened again since
+            if self._spec is spec:
+                self._disconnect()
+            raise
+
+    def _send_light_intensity(self, lightSource, intensity):
+        lightSource.set_intensity(intensity)
             
-        return self._int_time_min
-
     def update_light_source(self, ls):
-        if(ls is not None and ls is not ""):
+        if(ls is not None and ls != ""):
             ls.set_enable(True)
 
         
 class DemoSpectrometer(DashOceanOpticsSpectrometer):
 
-    def __init__(self, specLock, commLock):
-        super().__init__(specLock, commLock)
-        try:
-            self.spec_lock.acquire()
-            self.assign_spec()
-        except Exception:
-            pass
-        finally:
-            self.spec_lock.release()
-        self.controlFunctions = {
+    def __init__(self, commandTimeout=10, syntheticSpectrum=None,
+                 readTimeout=10):
+        super().__init__(commandTimeout, readTimeout)
+        # generates the fake spectra; a single peak at 500 nm by default
+        self._synthetic = (SyntheticSpectrum() if syntheticSpectrum is None
+                           else syntheticSpectrum)
+        self.device_info()
+        self._controlFunctions = {
             'integration-time-input':
-            "self.integration_time_demo",
+            (self.integration_time_demo, int),
 
             'nscans-to-average-input':
-            "self.empty_control_demo",
+            (self.empty_control_demo, int),
 
             'continuous-strobe-toggle-input':
-            "self.empty_control_demo",
+            (self.empty_control_demo, bool),
 
             'continuous-strobe-period-input':
-            "self.empty_control_demo",
+            (self.empty_control_demo, int),
 
             'light-source-input':
-            "self.exception_demo"
+            (self.exception_demo, None)
         }
-        self._sample_data_scale = self._int_time_min
+        self._sample_data_scale = self.int_time_min()
         self._sample_data_add = 0
+        self._min_frame_period = 0.05     # cap demo frame rate (s)
 
-    def assign_spec(self):
-        self._specmodel = "USB2000+"
-        self._lightSources = [{'label': 'Lamp 1 at 127.0.0.1', 'value': 'l1'},
-                              {'label': 'Lamp 2 at 127.0.0.1', 'value': 'l2'}]
-
-    def get_spectrum(self, int_time_demo_val=1000):
-        self._spectralData[0] = numpy.linspace(400, 900, 5000)
-        self._spectralData[1] = [self.sample_spectrum(wl)
-                                 for wl in self._spectralData[0]]
-
-        return self._spectralData
-
-    def send_control_values(self, commands):
-        failed = {}
-        succeeded = {}
+    def _assign_spec(self):
+        if self._device_info is not None:
+            return
+        self._device_info = DeviceInfo(
+            model="USB2000+",
+            serial="DEMO0000",
+            pixels=self._synthetic.pixels(),
+            wavelengths=self._synthetic.wavelengths(),
+            lightSources=[{'label': 'Lamp 1 at 127.0.0.1', 'value': 'l1'},
+                          {'label': 'Lamp 2 at 127.0.0.1', 'value': 'l2'}],
+            maxIntensity=65535
+        )
 
-        for ctrl_id in commands:
-            try:
-                eval(self.controlFunctions[ctrl_id])(commands[ctrl_id])
-                succeeded[ctrl_id] = str(commands[ctrl_id])
-            except Exception as e:
-                failed[ctrl_id] = str(e)
+    # simulates a read that takes as long as the integration time
+    def _read_spectrum(self):
+        self._assign_spec()
+        time.sleep(max(self._sample_data_scale / 1e6, self._min_frame_period))
+        intensities = self._synthetic.intensities(self._sample_data_scale,
+                                                  self._sample_data_add * 10)
+        # like a real detector, the counts stop at the saturation level
+        numpy.minimum(intensities, self._device_info.max_intensity,
+                      out=intensities)
 
-        return(failed, succeeded)
+        return [self._synthetic.wavelengths(), intensities]
 
-    def send_light_intensity(self, lightSource, intensity):
+    def _send_light_intensity(self, lightSource, intensity):
         if(lightSource == 'l1'):
             return
         elif(lightSource == 'l2'):
             self._sample_data_add = intensity
         else:
             self._sample_data_add = 0
-            
-    def model(self):
-        return self._specmodel
-    
-    def light_sources(self):
-        return self._lightSources
-
-    def int_time_max(self):
-        return self._int_time_max
-
-    def int_time_min(self):
-        return self._int_time_min
 
     # demo-specific methods
     
-    # generates a sample spectrum that's normally distributed about 500 nm
-    def sample_spectrum(self, x):
-        return (self._sample_data_scale * (numpy.e**(-1 * ((x-500) / 5)**2) +
-                                           0.01 * random.random()) +
-                self._sample_data_add * 10)
-
     def integration_time_demo(self, x):
         self._sample_data_scale = x
 
@@ -289,6 +759,127 @@ class DemoSpectrometer(DashOceanOpticsSpectrometer):
             return
 
 
+# plays back a recording made with SpectrumRecorder (see recording.py);
+# spectra are read straight from the memory-mapped files, with the
+# timing they were recorded with divided by speed (None or 0 plays them
+# as fast as they are asked for); pauses in the recording longer than
+# maxGap seconds are shortened to maxGap
+class ReplaySpectrometer(DashOceanOpticsSpectrometer):
+
+    def __init__(self, directory, speed=1.0, loop=True, maxGap=1.0,
+                 commandTimeout=10, readTimeout=10):
+        super().__init__(commandTimeout, readTimeout)
+        self._directory = directory
+        self._recording = None            # RecordingReader
+        self._speed = speed
+        self._loop = loop                 # start again at the end
+        self._max_gap = maxGap
+        self._position = 0                # next frame to play
+        self._due = None                  # when it is to be played
+        self.device_info()
+
+    def _assign_spec(self):
+        if self._device_info is not None:
+            return
+        recording = RecordingReader(self._directory)
+        if len(recording) == 0:
+            return
+        wavelengths = recording.frame(0)[0]
+        self._recording = recording
+        self._device_info = DeviceInfo(
+            model="replay",
+            serial=os.path.basename(os.path.normpath(self._directory)),
+            pixels=len(wavelengths),
+            wavelengths=wavelengths
+        )
+
+    def _disconnect(self):
+        self._recording = None
+        self._device_info = None
+
+    def _abandon(self):
+        self._disconnect()
+
+    def _read_spectrum(self):
+        self._assign_spec()
+        recording = self._recording
+        if recording is None:
+            raise Exception("The recording has no frames.")
+        if self._position >= len(recording):
+            if not self._loop:
+                raise Exception("The end of the recording was reached.")
+            # picks up anything recorded since
+            self._disconnect()
+            self._assign_spec()
+            recording = self._recording
+            self._position = 0
+            self._due = None
+
+        if self._speed and self._due is not None:
+            delay = self._due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        wavelengths, intensities, entry = recording.frame(self._position)
+        self._position += 1
+
+        if self._speed and self._position < len(recording):
+            now = time.time()
+            # after a stall, continue from now instead of catching up
+            if self._due is None or self._due < now - self._max_gap:
+                self._due = now
+            gap = recording.timestamps()[self._position] - entry['timestamp']
+            self._due += min(gap, self._max_gap) / self._speed
+
+        return [wavelengths, intensities]
+
+    # a recording cannot be changed
+    def _send_control_values(self, commands):
+        return ({ctrl_id: 'not available while replaying a recording'
+                 for ctrl_id in commands}, {},
+                {ctrl_id: 0.0 for ctrl_id in commands})
+
+    def _seek(self, seconds):
+        self._assign_spec()
+        if self._recording is None:
+            return
+        timestamps = self._recording.timestamps()
+        self._position = min(self._recording.find(timestamps[0] + seconds),
+                             len(self._recording) - 1)
+        self._due = None
+
+    def _set_speed(self, speed):
+        self._speed = speed
+        self._due = None
+
+    # replay-specific methods
+
+    # continue playing from the first frame taken at least seconds after
+    # the start of the recording
+    def seek(self, seconds):
+        self._device_call(PRIORITY_SETTINGS, self._seek, seconds)
+
+    def set_speed(self, speed):
+        self._device_call(PRIORITY_SETTINGS, self._set_speed, speed)
+
+    # seconds from the start of the recording to the frame playing next,
+    # and to its end
+    def position(self):
+        recording = self._recording
+        if recording is None or len(recording) == 0:
+            return 0.0
+        timestamps = recording.timestamps()
+        position = min(self._position, len(timestamps) - 1)
+        return float(timestamps[position] - timestamps[0])
+
+    def duration(self):
+        recording = self._recording
+        if recording is None or len(recording) == 0:
+            return 0.0
+        timestamps = recording.timestamps()
+        return float(timestamps[-1] - timestamps[0])
+
+
 # class to represent all controls
 class Control:
     def __init__(self, new_ctrl_id, new_ctrl_name,
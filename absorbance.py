@@ -0,0 +1,141 @@
+import os
+import re
+import time
+import threading
+
+import numpy
+
+# what the plot shows: raw counts, or the spectrum relative to the
+# captured dark and reference spectra
+DISPLAY_MODES = ('counts', 'transmittance', 'absorbance')
+
+# pixels whose reference is less than this many counts above the dark
+# are left out
+MIN_SIGNAL = 1.0
+
+
+# dark and reference spectra are only valid for the device and settings
+# they were taken with
+def reference_key(serial, settings):
+    settings = settings or {}
+    key = '%s-%s-%s' % (serial,
+                        settings.get('integration-time-input', 'default'),
+                        settings.get('nscans-to-average-input', 1))
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', key)
+
+
+# dark ('dark') and reference ('reference') spectra, saved as .npy files
+# so that every web worker sees them and they survive a restart; loaded
+# files are cached, and reloaded when they change
+class ReferenceStore:
+
+    def __init__(self, directory, checkInterval=1.0):
+        self._directory = directory
+        self._check_interval = checkInterval  # between file checks (s)
+        self._lock = threading.Lock()
+        self._cache = {}                      # path -> (checked, mtime, array)
+
+    def _path(self, kind, key):
+        return os.path.join(self._directory, '%s.%s.npy' % (key, kind))
+
+    def save(self, kind, key, intensities):
+        os.makedirs(self._directory, exist_ok=True)
+        path = self._path(kind, key)
+        # written next to it and renamed, so readers never see half a file
+        partial = path + '.partial.npy'
+        numpy.save(partial, numpy.asarray(intensities, dtype=numpy.float64))
+        os.replace(partial, path)
+        with self._lock:
+            self._cache.pop(path, None)
+
+    # the saved spectrum, or None if there is none
+    def load(self, kind, key):
+        path = self._path(kind, key)
+        now = time.time()
+        with self._lock:
+            checked, mtime, values = self._cache.get(path, (0.0, None, None))
+            if now - checked < self._check_interval:
+                return values
+            try:
+                current = os.stat(path).st_mtime
+            except OSError:
+                current = None
+            if current != mtime:
+                values = None if current is None else numpy.load(path)
+                if values is not None:
+                    values.flags.writeable = False
+            self._cache[path] = (now, current, values)
+            return values
+
+
+# transmittance and absorbance of frames relative to the stored dark and
+# reference; 1 / (reference - dark) is worked out once per pair of
+# captures, so a frame only costs a subtraction and a multiplication
+# (and a logarithm for absorbance); pixels that cannot be computed (too
+# little signal in the reference, or saturated) are nan
+class AbsorbanceCalculator:
+
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.Lock()
+        # dark, reference, saturation level, and the dark and inverse
+        # denominator worked out from them
+        self._denominator = (None, None, None, None, None)
+        # seq, mode and key of the last result, and the result
+        self._last = (None, None, None, None)
+
+    # whether a reference has been captured for key
+    def ready(self, key):
+        return self._store.load('reference', key) is not None
+
+    def _inverse(self, key, pixels, saturationLevel):
+        dark = self._store.load('dark', key)
+        reference = self._store.load('reference', key)
+        if reference is None or len(reference) != pixels:
+            return None, None
+        if dark is not None and len(dark) != pixels:
+            dark = None
+
+        last_dark, last_reference, last_level, offset, inverse = \
+            self._denominator
+        if dark is last_dark and reference is last_reference and \
+           saturationLevel == last_level:
+            return offset, inverse
+
+        offset = dark if dark is not None else numpy.zeros(pixels)
+        denominator = reference - offset
+        valid = denominator >= MIN_SIGNAL
+        if saturationLevel is not None:
+            valid &= reference < saturationLevel
+        inverse = numpy.full(pixels, numpy.nan)
+        inverse[valid] = 1.0 / denominator[valid]
+        self._denominator = (dark, reference, saturationLevel, offset,
+                             inverse)
+        return offset, inverse
+
+    # frame's intensities in the given display mode; None if the mode
+    # needs a reference that has not been captured
+    def compute(self, frame, mode, key, saturationLevel=None):
+        if mode == 'counts':
+            return frame.intensities
+
+        with self._lock:
+            seq, last_mode, last_key, values = self._last
+            if (seq, last_mode, last_key) == (frame.seq, mode, key):
+                return values
+
+            offset, inverse = self._inverse(key, len(frame.intensities),
+                                            saturationLevel)
+            if inverse is None:
+                return None
+
+            values = (frame.intensities - offset) * inverse
+            if frame.saturated and saturationLevel is not None:
+                values[frame.intensities >= saturationLevel] = numpy.nan
+            if mode == 'absorbance':
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    values = -numpy.log10(values)
+                values[~numpy.isfinite(values)] = numpy.nan
+            values.flags.writeable = False
+            self._last = (frame.seq, mode, key, values)
+            return values
@@ -0,0 +1,253 @@
+import time
+import threading
+from collections import OrderedDict, deque
+
+import numpy
+
+
+# summary of a spectrum: (min, max, argmax, integral, saturated), where
+# the integral is over wavelength and saturated tells whether any pixel
+# reached saturationLevel
+def spectrum_stats(wavelengths, intensities, saturationLevel=None):
+    if len(intensities) == 0:
+        return (0.0, 0.0, 0, 0.0, False)
+    argmax = int(intensities.argmax())
+    peak = float(intensities[argmax])
+    # trapezoidal rule
+    integral = float(numpy.dot(numpy.diff(wavelengths),
+                               intensities[1:] + intensities[:-1]) / 2)
+    saturated = saturationLevel is not None and peak >= saturationLevel
+    return (float(intensities.min()), peak, argmax, integral, saturated)
+
+
+# a single spectrum read from the spectrometer; seq increases by one for
+# every frame acquired, timestamp is the time (seconds since the epoch)
+# at which the read completed, and settings are the control values in
+# effect at the time
+#
+# frames are immutable, their arrays are read-only and their statistics
+# are computed once when they are created, so every consumer can share
+# one frame without copying or rescanning it
+class Frame:
+    __slots__ = ('seq', 'timestamp', 'wavelengths', 'intensities',
+                 'settings', 'min', 'max', 'argmax', 'integral', 'saturated')
+
+    def __init__(self, seq, timestamp, wavelengths, intensities,
+                 settings=None, stats=None):
+        wavelengths = _read_only(wavelengths)
+        intensities = _read_only(intensities)
+        if stats is None:
+            stats = spectrum_stats(wavelengths, intensities)
+        values = (seq, timestamp, wavelengths, intensities,
+                  settings) + tuple(stats)
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("frames are immutable")
+
+    def __reduce__(self):
+        return (Frame, (self.seq, self.timestamp, self.wavelengths,
+                        self.intensities, self.settings, self.stats()))
+
+    def stats(self):
+        return (self.min, self.max, self.argmax, self.integral,
+                self.saturated)
+
+    def __repr__(self):
+        return 'Frame(seq=%d, timestamp=%f, pixels=%d)' % (
+            self.seq, self.timestamp, len(self.intensities))
+
+
+def _read_only(values):
+    if isinstance(values, numpy.ndarray) and not values.flags.writeable:
+        return values
+    view = numpy.asarray(values).view()
+    view.flags.writeable = False
+    return view
+
+
+# bounded cache of the most recent frames, shared by every client; the
+# oldest frame is dropped once the buffer is full
+class FrameRingBuffer:
+
+    def __init__(self, capacity, dtype=None):
+        self._frames = deque(maxlen=capacity)
+        self._dtype = dtype                # e.g. float32 to halve memory
+        self._cond = threading.Condition()
+        self._next_seq = 1
+        self._last_read = 0.0              # when a client last read a frame
+        self._wavelengths = (None, None)   # calibration and read-only view
+
+    # store a newly acquired spectrum and wake up anyone waiting for it
+    def publish(self, timestamp, wavelengths, intensities, settings=None,
+                saturationLevel=None):
+        # every frame of a device shares one wavelength array
+        if wavelengths is not self._wavelengths[0]:
+            self._wavelengths = (wavelengths, _read_only(wavelengths))
+        wavelengths = self._wavelengths[1]
+        intensities = numpy.asarray(intensities, dtype=self._dtype)
+        stats = spectrum_stats(wavelengths, intensities, saturationLevel)
+        with self._cond:
+            frame = Frame(self._next_seq, timestamp, wavelengths,
+                          intensities, settings, stats)
+            self._next_seq += 1
+            self._frames.append(frame)
+            self._cond.notify_all()
+        return frame
+
+    # newest frame, or None if nothing has been acquired yet
+    def latest(self):
+        with self._cond:
+            if len(self._frames) == 0:
+                return None
+            return self._frames[-1]
+
+    # sequence number of the newest frame; 0 if there is none
+    def latest_seq(self):
+        with self._cond:
+            return self._next_seq - 1
+
+    # block until a frame newer than seq is available; returns it, or None
+    # on timeout
+    def wait_for_frame(self, seq, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._next_seq - 1 > seq,
+                                       timeout):
+                return None
+            return self._frames[-1]
+
+    # typical time (s) between the most recent frames; None if fewer than
+    # two have been acquired
+    def frame_period(self, frames=8):
+        with self._cond:
+            timestamps = [f.timestamp for f in
+                          list(self._frames)[-frames:]]
+        if len(timestamps) < 2:
+            return None
+        return float(numpy.median(numpy.diff(timestamps)))
+
+    # snapshot of all buffered frames, oldest first
+    def frames(self):
+        with self._cond:
+            return list(self._frames)
+
+    # record that a client wants frames, so acquisition keeps running
+    def touch(self):
+        with self._cond:
+            self._last_read = time.time()
+            self._cond.notify_all()
+
+    # block until a client has read a frame within the last idleTimeout
+    # seconds; returns whether there is demand
+    def wait_for_demand(self, idleTimeout, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: time.time() - self._last_read < idleTimeout,
+                timeout
+            )
+
+    def capacity(self):
+        return self._frames.maxlen
+
+    def __len__(self):
+        with self._cond:
+            return len(self._frames)
+
+
+# reads spectra continuously on its own thread, so that the device runs at
+# its natural frame rate and readers never wait on the hardware; every
+# frame is acquired once and shared by all clients, and acquisition pauses
+# when no client has asked for a frame in idleTimeout seconds
+class AcquisitionThread(threading.Thread):
+
+    def __init__(self, spec, frameBuffer, retryInterval=0.5, idleTimeout=10):
+        super().__init__(name='spectrometer-acquisition', daemon=True)
+        self._spec = spec                    # spectrometer to read from
+        self._buffer = frameBuffer           # where new frames are stored
+        self._retry_interval = retryInterval  # wait after a failed read (s)
+        self._idle_timeout = idleTimeout     # pause without readers (s)
+        self._stop_event = threading.Event()
+        self._listeners = []                 # called with every new frame
+        self._keep_running = []              # those that prevent pausing
+
+    # have listener(frame) called on this thread with every frame; while
+    # there are listeners added with keepRunning (e.g. a recording)
+    # acquisition never pauses, others (e.g. analyses) only see the frames
+    # that clients ask for anyway
+    def add_listener(self, listener, keepRunning=True):
+        self._listeners = self._listeners + [listener]
+        if keepRunning:
+            self._keep_running = self._keep_running + [listener]
+
+    def remove_listener(self, listener):
+        self._listeners = [l for l in self._listeners if l != listener]
+        self._keep_running = [l for l in self._keep_running
+                              if l != listener]
+
+    def run(self):
+        while not self._stop_event.is_set():
+            if len(self._keep_running) == 0 and \
+               not self._buffer.wait_for_demand(self._idle_timeout,
+                                                self._retry_interval):
+                continue
+
+            try:
+                spectrum = self._spec.read_spectrum()
+            except Exception:
+                spectrum = None
+
+            # back off instead of spinning if the device is unavailable
+            if spectrum is None:
+                self._stop_event.wait(self._retry_interval)
+                continue
+
+            intensities = self._spec.process_spectrum(spectrum[1])
+            frame = self._buffer.publish(time.time(), spectrum[0],
+                                         intensities, self._spec.settings(),
+                                         self._spec.saturation_level())
+            # e.g. auto exposure; its failure must not stop acquisition
+            try:
+                self._spec.frame_published(frame)
+            except Exception:
+                pass
+
+            for listener in self._listeners:
+                try:
+                    listener(frame)
+                except Exception:
+                    # a failing listener (e.g. a full disk) must not stop
+                    # acquisition; it is dropped instead
+                    self.remove_listener(listener)
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        self.join(timeout)
+
+
+# remembers what each client was last sent, so that polls which would
+# produce an identical response can be skipped; only the most recently
+# active maxClients clients are tracked
+class FrameDeliveryTracker:
+
+    def __init__(self, maxClients=1000):
+        self._delivered = OrderedDict()
+        self._max_clients = maxClients
+        self._lock = threading.Lock()
+
+    # record that the client is about to be sent state; returns False if
+    # that is exactly what it was sent last time
+    def update(self, clientId, state):
+        with self._lock:
+            if self._delivered.get(clientId) == state:
+                self._delivered.move_to_end(clientId)
+                return False
+            self._delivered[clientId] = state
+            self._delivered.move_to_end(clientId)
+            while len(self._delivered) > self._max_clients:
+                self._delivered.popitem(last=False)
+            return True
+
+    def forget(self, clientId):
+        with self._lock:
+            self._delivered.pop(clientId, None)
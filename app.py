@@ -2,54 +2,147 @@
 
 import os
 import sys
-import numpy
-from threading import Lock
 import time
+import uuid
 from textwrap import dedent
 
+import numpy
+
 import dash
 import dash_html_components as html
 import dash_core_components as dcc
 
-import plotly.graph_objs as go
-
 import dash_daq as daq
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 
 import DashOceanOpticsSpectrometer as doos
 from DashOceanOpticsSpectrometer import Control
+from sharedacquisition import RemoteSpectrometer
+from decimation import Decimator
+from figures import (SpectrumFigureTemplate, fast_json_callback,
+                     load_colors)
+from streaming import streaming_blueprint
+from export import export_blueprint
+from waterfall import (new_waterfall_rows, waterfall_figure,
+                       waterfall_rows_json)
+from peaks import PeakFinder, analysis_blueprint
+from absorbance import (AbsorbanceCalculator, ReferenceStore,
+                        reference_key)
+
+DEMO = (('DASH_PATH_ROUTING' in os.environ) or
+        (len(sys.argv) == 2 and sys.argv[1] == "demo"))
+
+# directory of a recording to play back instead of using a spectrometer,
+# and how many times faster than real time (0 for as fast as possible)
+REPLAY = os.environ.get(
+    'SPECTROMETER_REPLAY',
+    sys.argv[2] if len(sys.argv) == 3 and sys.argv[1] == "replay" else None
+)
+REPLAY_SPEED = float(os.environ.get('SPECTROMETER_REPLAY_SPEED', 1.0))
+
+# number of recent frames kept by the background acquisition, and the
+# type their intensities are stored as
+FRAME_BUFFER_SIZE = 64
+FRAME_DTYPE = 'float32'
+
+# the plot never shows more detail than it has pixels, so spectra are
+# reduced to this width before being sent ('minmax' or 'lttb')
+PLOT_WIDTH = 1500
+DECIMATION_METHOD = 'minmax'
+
+# significant digits kept when sending spectra to the browser (None for
+# full precision)
+PLOT_PRECISION = 7
+
+# the plot polls for new frames about twice per frame period, within
+# these limits (ms); the period is taken from the frames themselves
+REFRESH_INTERVALS = [100, 200, 250, 500, 1000, 2000, 5000]
 
-DEMO = False
+# how often the polling interval is adapted to the frame rate (ms); kept
+# apart from the polling itself, so that it does not add a request to
+# every poll
+REFRESH_CHECK_INTERVAL = 2000
+
+# the waterfall shows this many rows of this many seconds each, at this
+# many wavelength bins; its memory is fixed by these
+WATERFALL_ROWS = 300
+WATERFALL_ROW_PERIOD = 1.0
+WATERFALL_COLUMNS = 500
+
+# wavelength bands (name, from, to in nm) whose peak is followed over
+# time, and how many frames of their history are kept
+PEAK_BANDS = [('500 nm', 480, 520)]
+PEAK_HISTORY = 3600
+
+# captured dark and reference spectra are kept in here
+REFERENCE_DIR = os.environ.get('SPECTROMETER_REFERENCE_DIR', 'references')
+
+# recordings are written to a new directory in here, in chunks of this
+# many frames
+RECORDING_DIR = os.environ.get('SPECTROMETER_RECORDING_DIR', 'recordings')
+RECORDING_CHUNK_FRAMES = 1000
+
+# how often the device health shown in the status box is refreshed (ms)
+HEALTH_INTERVAL = 2000
 
 #############################
 # Spectrometer properties
 #############################
 
-# lock for modifying information about spectrometer
-spec_lock = Lock()
-# lock for communicating with spectrometer
-comm_lock = Lock()
+# demo, replay or actual; each spectrometer does all of its communication
+# on its own device thread, so callbacks never need to lock it
+if('SPECTROMETER_ACQUISITION_DIR' in os.environ):
+    # a separate acquisition process owns the device (see gunicorn.conf.py)
+    spec = RemoteSpectrometer(
+        os.environ['SPECTROMETER_ACQUISITION_DIR'],
+        bytes.fromhex(os.environ['SPECTROMETER_AUTHKEY'])
+    )
+elif(REPLAY is not None):
+    spec = doos.ReplaySpectrometer(REPLAY, REPLAY_SPEED)
+elif(DEMO):
+    spec = doos.DemoSpectrometer()
+else:
+    spec = doos.PhysicalSpectrometer()
 
-# initialize spec
-spec = doos.DashOceanOpticsSpectrometer(spec_lock, comm_lock)
+# read spectra continuously in the background; the plot callback only
+# picks up the newest frame
+spec.start_acquisition(FRAME_BUFFER_SIZE, FRAME_DTYPE)
 
-# demo or actual
-if(('DASH_PATH_ROUTING' in os.environ) or (len(sys.argv) == 2 and sys.argv[1] == "demo")):
-    spec = doos.DemoSpectrometer(spec_lock, comm_lock)
-    DEMO = True
-else:
-    spec = doos.PhysicalSpectrometer(spec_lock, comm_lock)
-    
-spec.assign_spec()
+# last frame sent to each browser session, by whichever worker sent it
+delivered_frames = spec.delivery_tracker()
+
+# reduces frames for display
+decimator = Decimator(PLOT_WIDTH, DECIMATION_METHOD)
+
+# transmittance and absorbance relative to the captured spectra
+references = ReferenceStore(REFERENCE_DIR)
+absorbance = AbsorbanceCalculator(references)
+
+# peaks of the newest frame, and the bands over time; the bands are
+# followed in every acquired frame where the frames are acquired
+peak_finder = PeakFinder()
+spec.start_peak_tracking(PEAK_BANDS, PEAK_HISTORY)
+
+# recent spectra over time, binned to the size of the waterfall plot;
+# built from every acquired frame where the frames are acquired
+spec.start_waterfall(WATERFALL_ROWS, WATERFALL_COLUMNS, WATERFALL_ROW_PERIOD)
 
 
 ############################
 # Begin Dash app
 ############################
 
-app = dash.Dash()
+# assets/ holds the script that appends rows to the waterfall
+app = dash.Dash(assets_folder=os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'assets'))
 server = app.server
 
+# spectra are also pushed to subscribers as soon as they are acquired
+server.register_blueprint(streaming_blueprint(spec))
+server.register_blueprint(export_blueprint(spec, RECORDING_DIR))
+server.register_blueprint(analysis_blueprint(spec, peak_finder))
+
 ############################
 # Style
 ############################
@@ -58,11 +151,7 @@ app.css.append_css({
     "external_url": "https://rawgit.com/shammamah/dash-stylesheets/master/dash-ocean-optics-stylesheet.css"
 })
 
-colors = {}
-
-with open("colors.txt", 'r') as f:
-    for line in f.readlines():
-        colors[line.split(' ')[0]] = line.split(' ')[1].strip('\n')
+colors = load_colors("colors.txt")
 
         
 ############################
@@ -128,11 +217,79 @@ light_sources = Control('light-source', "light source",
                         )
 controls.append(light_sources)
 
+# adjust the integration time automatically
+auto_exposure = Control('auto-exposure', "auto exposure",
+                        "BooleanSwitch",
+                        {'id': 'auto-exposure-input',
+                         'color': colors['accent'],
+                         'on': False
+                         }
+                        )
+controls.append(auto_exposure)
+
+# how full auto exposure makes the detector, % of saturation
+exposure_target = Control('exposure-target', "exposure target (%)",
+                          "NumericInput",
+                          {'id': 'exposure-target-input',
+                           'max': 95,
+                           'min': 10,
+                           'size': 150,
+                           'value': 80
+                           }
+                          )
+controls.append(exposure_target)
+
+# host-side averaging of the acquired spectra
+averaging_mode = Control('averaging-mode', "averaging",
+                         "Dropdown",
+                         {'id': 'averaging-mode-input',
+                          'options': [
+                              {'label': 'none', 'value': 'none'},
+                              {'label': 'rolling mean', 'value': 'rolling'},
+                              {'label': 'exponential', 'value': 'ema'}
+                          ],
+                          'clearable': False,
+                          'value': 'none'
+                          }
+                         )
+controls.append(averaging_mode)
+
+# frames averaged over (the effective number for the exponential mean)
+averaging_frames = Control('averaging-frames', "frames to average",
+                           "NumericInput",
+                           {'id': 'averaging-frames-input',
+                            'max': 1000,
+                            'min': 1,
+                            'size': 150,
+                            'value': 10
+                            }
+                           )
+controls.append(averaging_frames)
+
+# boxcar smoothing over neighbouring pixels
+boxcar_width = Control('boxcar-width', "boxcar (pixels)",
+                       "NumericInput",
+                       {'id': 'boxcar-width-input',
+                        'max': 101,
+                        'min': 1,
+                        'size': 150,
+                        'value': 1
+                        }
+                       )
+controls.append(boxcar_width)
+
 
 ############################
 # Layout
 ############################
 
+# shown as on while a recording is running, whoever started it
+record_switch = daq.BooleanSwitch(
+    id='record-switch',
+    on=False,
+    color=colors['accent']
+)
+
 page_layout = [html.Div(id='page', children=[
 
     # banner
@@ -171,12 +328,29 @@ page_layout = [html.Div(id='page', children=[
                         ]
                     ),
                     dcc.Graph(id='spec-readings', animate=True),
+                    # adapted to the frame rate by update_refresh_interval,
+                    # and stopped while the power is off
                     dcc.Interval(
                         id='spec-reading-interval',
                         interval=1 * 1000,
                         n_intervals=0,
-                        max_intervals=300 # stop after 5 mins.
-                        # otherwise server has to handle callbacks for idle app
+                        disabled=not (DEMO or REPLAY)
+                    ),
+                    dcc.Interval(
+                        id='refresh-check-interval',
+                        interval=REFRESH_CHECK_INTERVAL,
+                        n_intervals=0
+                    ),
+                    # peaks found in the newest spectrum
+                    html.Div(id='peak-table'),
+                    # history of the spectra over time
+                    dcc.Graph(id='waterfall'),
+                    # rows for assets/waterfall.js to append to it
+                    html.Div(
+                        id='waterfall-rows',
+                        style={
+                            'display': 'none'
+                        }
                     )
                 ]
             )
@@ -193,7 +367,7 @@ page_layout = [html.Div(id='page', children=[
                 id='power-button',
                 size=50,
                 color=colors['accent'],
-                on=True if DEMO else False
+                on=True if DEMO or REPLAY else False
             )
         ],
     ),
@@ -240,6 +414,106 @@ page_layout = [html.Div(id='page', children=[
                     )
                 ]
             ),
+            # display mode
+            html.Div(
+                className='status-box-title',
+                children=[
+                    "display"
+                ]
+            ),
+            html.Div(
+                id='display-mode-container',
+                title='Shows the raw counts, or the transmittance or \
+                absorbance relative to the captured dark and reference.',
+                children=[
+                    dcc.Dropdown(
+                        id='display-mode',
+                        options=[
+                            {'label': 'counts', 'value': 'counts'},
+                            {'label': 'transmittance',
+                             'value': 'transmittance'},
+                            {'label': 'absorbance', 'value': 'absorbance'}
+                        ],
+                        clearable=False,
+                        value='counts'
+                    )
+                ]
+            ),
+            html.Div(
+                id='capture-buttons-container',
+                title='Captures the current spectrum as the dark (light \
+                source off) or the reference (no sample) for the current \
+                settings.',
+                children=[
+                    html.Button(
+                        'capture dark',
+                        id='capture-dark-button',
+                        n_clicks=0,
+                        n_clicks_timestamp=0
+                    ),
+                    html.Button(
+                        'capture reference',
+                        id='capture-reference-button',
+                        n_clicks=0,
+                        n_clicks_timestamp=0
+                    )
+                ]
+            ),
+            html.Div(
+                id='reference-status',
+                children=[
+                    ""
+                ]
+            ),
+            # recording
+            html.Div(
+                className='status-box-title',
+                children=[
+                    "record spectra"
+                ]
+            ),
+            html.Div(
+                id='record-switch-container',
+                title='Writes every acquired spectrum to disk.',
+                children=[
+                    record_switch
+                ]
+            ),
+            html.Div(
+                id='record-status',
+                children=[
+                    ""
+                ]
+            ),
+            # reads, failures and reconnections of the device
+            html.Div(
+                className='status-box-title',
+                children=[
+                    "device health"
+                ]
+            ),
+            html.Div(
+                id='device-health',
+                children=[
+                    ""
+                ]
+            ),
+            dcc.Interval(
+                id='health-interval',
+                interval=HEALTH_INTERVAL,
+                n_intervals=0
+            ),
+            # downloads of the spectra in the ring buffer
+            html.Div(
+                id='export-links',
+                title='Downloads the most recently acquired spectra.',
+                children=[
+                    "export recent spectra: ",
+                    html.A('csv', href='/export/spectra.csv'),
+                    " | ",
+                    html.A('npz', href='/export/spectra.npz')
+                ]
+            ),
 
             # submit button
             html.Div(
@@ -324,7 +598,23 @@ page_layout = [html.Div(id='page', children=[
 
 ])]
 
-app.layout = html.Div(id='main', children=page_layout)
+
+# each page load gets its own session id, so that the server can tell
+# which frames a given client has already seen
+def serve_layout():
+    record_switch.on = spec.recording_status() is not None
+    return html.Div(id='main', children=page_layout + [
+        html.Div(
+            id='session-id',
+            style={
+                'display': 'none'
+            },
+            children=str(uuid.uuid4())
+        )
+    ])
+
+
+app.layout = serve_layout
 
 
 ############################
@@ -378,7 +668,8 @@ def disable_enable_controls(pwr_on):
     return [ctrl.create_ctrl_div(not pwr_on) for ctrl in controls]
 
 
-# send light intensity to spectrometer
+# send light intensity to spectrometer; this only queues it, so turning
+# the knob never waits on the device
 @app.callback(
     Output('hidden-div-send-ls', 'children'),
     [Input('light-intensity-knob', 'value')],
@@ -414,6 +705,13 @@ def enable_disable_light_intensity(ls, pwr):
     )]
 
 
+# how long a command took, for the update summary
+def command_time(seconds):
+    if(seconds is None):
+        return " (unchanged)"
+    return " (%.1f ms)" % (seconds * 1000)
+
+
 # send user-selected options to spectrometer
 @app.callback(
     Output('submit-status', 'children'),
@@ -438,7 +736,9 @@ def update_spec_params(n_clicks, *args):
     commands = {controls[i].component_attr['id']: args[i]
                 for i in range(len(controls))}
             
-    failed, succeeded = spec.send_control_values(commands)
+    # only the values that changed are sent; each result says how long
+    # the command took
+    failed, succeeded, timings = spec.send_control_values(commands)
     
     summary = []
     
@@ -453,7 +753,8 @@ def update_spec_params(n_clicks, *args):
             # for readability
             [ctrlName] = [c.ctrl_name for c in controls
                           if c.component_attr['id'] == f]
-            summary.append(ctrlName.upper() + ': ' + failed[f])
+            summary.append(ctrlName.upper() + ': ' + failed[f] +
+                           command_time(timings.get(f)))
             summary.append(html.Br())
 
         summary.append(html.Br())
@@ -469,106 +770,304 @@ def update_spec_params(n_clicks, *args):
         for s in succeeded:
             [ctrlName] = [c.ctrl_name for c in controls
                           if c.component_attr['id'] == s]
-            summary.append(ctrlName.upper() + ': ' + succeeded[s])
+            summary.append(ctrlName.upper() + ': ' + succeeded[s] +
+                           command_time(timings.get(s)))
             summary.append(html.Br())
 
     return html.Div(summary)
 
 
-# update the plot
+# stop polling for frames while the power is off
+@app.callback(
+    Output('spec-reading-interval', 'disabled'),
+    [Input('power-button', 'on')]
+)
+def enable_disable_refresh(pwr_on):
+    return not pwr_on
+
+
+# poll no faster than frames arrive; if frames stop arriving (e.g. the
+# device was unplugged), back off as the newest one gets older; checked
+# every REFRESH_CHECK_INTERVAL rather than on every poll
+@app.callback(
+    Output('spec-reading-interval', 'interval'),
+    [Input('refresh-check-interval', 'n_intervals')],
+    state=[State('spec-reading-interval', 'interval'),
+           State('power-button', 'on')]
+)
+def update_refresh_interval(_, current, on):
+    if(not on):
+        raise PreventUpdate
+    period = spec.frame_period()
+    frame = spec.latest_frame()
+    if period is None or frame is None:
+        raise PreventUpdate
+    period = max(period, time.time() - frame.timestamp)
+
+    # the slowest interval that still catches every frame, rounded to a
+    # few fixed steps so that jitter does not keep resetting the timer
+    target = period * 1000 / 2
+    interval = REFRESH_INTERVALS[0]
+    for step in REFRESH_INTERVALS:
+        if step <= target:
+            interval = step
+
+    if interval == current:
+        raise PreventUpdate
+    return interval
+
+
+# start or stop recording every acquired frame; a page loaded while a
+# recording runs shows the switch on, so loading it leaves the recording
+# alone
 @app.callback(
+    Output('record-status', 'children'),
+    [Input('record-switch', 'on')]
+)
+def start_stop_recording(record):
+    status = spec.recording_status()
+    if(not record):
+        if(status is None):
+            return ""
+        spec.stop_recording()
+        return "recorded %d frames to %s" % (status['frames'],
+                                            status['directory'])
+    if(status is not None):
+        return "recording to %s" % status['directory']
+
+    directory = os.path.join(RECORDING_DIR,
+                             time.strftime('%Y%m%d-%H%M%S'))
+    try:
+        spec.start_recording(directory, RECORDING_CHUNK_FRAMES)
+    except Exception as e:
+        return "could not record: %s" % e
+    return "recording to %s" % directory
+
+
+# how long ago a unix time was, for the health summary
+def time_ago(timestamp, now):
+    if(timestamp is None):
+        return "never"
+    return "%.1f s ago" % max(now - timestamp, 0)
+
+
+# last frame, failures and reconnections of the device; the health is
+# kept by the spectrometer, so this only formats it
+@app.callback(
+    Output('device-health', 'children'),
+    [Input('health-interval', 'n_intervals')]
+)
+def update_device_health(_):
+    health = spec.health()
+    now = time.time()
+    lines = [
+        "last spectrum: %s" % time_ago(health['last_frame'], now),
+        "failed reads in a row: %d (%d in total)" % (
+            health['consecutive_failures'], health['failures']),
+        "connection attempts: %d, device thread restarts: %d" % (
+            health['reconnect_attempts'], health['worker_restarts'])
+    ]
+    if(health.get('stuck_threads', 0) > 0):
+        lines.append("device threads still stuck in the driver: %d" % (
+            health['stuck_threads']))
+    if(health.get('restarts_exhausted', False)):
+        lines.append("device thread not restarted again until a spectrum "
+                     "is read; restart the app if the device stays hung")
+    if(health['last_error'] is not None):
+        lines.append("last read error (%s): %s" % (
+            time_ago(health['last_error_time'], now),
+            health['last_error']))
+    if(health['last_command_error'] is not None):
+        lines.append("last command error (%s): %s" % (
+            time_ago(health['last_command_error_time'], now),
+            health['last_command_error']))
+    return [html.Div(line) for line in lines]
+
+
+# dark and reference spectra are kept per device and settings
+def current_reference_key(frame=None):
+    settings = frame.settings if frame is not None else None
+    if(settings is None):
+        settings = spec.settings()
+    return reference_key(spec.serial(), settings)
+
+
+# capture the newest frame as the dark or the reference spectrum
+@app.callback(
+    Output('reference-status', 'children'),
+    [Input('capture-dark-button', 'n_clicks_timestamp'),
+     Input('capture-reference-button', 'n_clicks_timestamp')]
+)
+def capture_reference_spectra(dark_clicked, reference_clicked):
+    if(dark_clicked or reference_clicked):
+        kind = 'dark' if dark_clicked > reference_clicked else 'reference'
+        frame = spec.latest_frame()
+        if(frame is None):
+            return "no spectrum to capture"
+        references.save(kind, current_reference_key(frame),
+                        frame.intensities)
+
+    key = current_reference_key(spec.latest_frame())
+    captured = [kind for kind in ('dark', 'reference')
+                if references.load(kind, key) is not None]
+    if(len(captured) == 0):
+        return "no dark or reference captured for these settings"
+    return "captured for these settings: %s" % ", ".join(captured)
+
+
+# x-axis range the user has zoomed the plot to, if any
+def zoomed_x_range(relayout_data):
+    if not relayout_data:
+        return None
+    if 'xaxis.range[0]' in relayout_data and \
+       'xaxis.range[1]' in relayout_data:
+        return (relayout_data['xaxis.range[0]'],
+                relayout_data['xaxis.range[1]'])
+    if 'xaxis.range' in relayout_data:
+        return tuple(relayout_data['xaxis.range'])
+    return None
+
+
+# layout and styling of the plot are only built when the colours or the
+# autoscale mode change; each tick just fills in the spectrum and ranges
+figure_template = SpectrumFigureTemplate("colors.txt", PLOT_PRECISION)
+
+
+# update the plot; the figure is encoded with the fast numpy-aware
+# encoder rather than the generic plotly one
+@fast_json_callback(
+    app,
     Output('spec-readings', 'figure'),
     inputs=[
-        Input('spec-reading-interval', 'n_intervals')
+        Input('spec-reading-interval', 'n_intervals'),
+        Input('power-button', 'on'),
+        Input('display-mode', 'value')
+    ],
+    state=[
+        State('autoscale-switch', 'on'),
+        State('session-id', 'children'),
+        State('spec-readings', 'relayoutData')
+    ]
+)
+def update_plot(_, on, display_mode, auto_range, session_id, relayout_data):
+
+    # every session reads the same cached frame; the spectrometer is only
+    # read once per frame no matter how many clients are polling
+    frame = spec.latest_frame() if on else None
+
+    # nothing has changed since this client's last poll; send nothing
+    seq = frame.seq if frame is not None else None
+    zoom = None if auto_range else zoomed_x_range(relayout_data)
+    if not delivered_frames.update(session_id,
+                                   (seq, on, display_mode, auto_range, zoom)):
+        raise PreventUpdate
+
+    if(frame is None):
+        return figure_template.empty()
+
+    # relative to the dark and reference; counts until a reference has
+    # been captured
+    values = frame.intensities
+    y_title = 'Intensity (AU)'
+    if(display_mode in ('transmittance', 'absorbance')):
+        relative = absorbance.compute(frame, display_mode,
+                                      current_reference_key(frame),
+                                      spec.saturation_level())
+        if(relative is not None):
+            values = relative
+            y_title = display_mode.capitalize()
+
+    # only the displayed copy is reduced; the frame keeps every pixel
+    wavelengths, intensities = decimator.decimate(frame.wavelengths,
+                                                  values, zoom)
+
+    x_range = None
+    y_range = None
+    if(auto_range):
+        x_range = [frame.wavelengths[0], frame.wavelengths[-1]]
+        if(values is frame.intensities):
+            # the frame's statistics were computed once when it was
+            # acquired
+            y_range = [frame.min, frame.max]
+        elif(numpy.isfinite(intensities).any()):
+            y_range = [numpy.nanmin(intensities), numpy.nanmax(intensities)]
+    elif(zoom is not None):
+        # keep the user's zoom, since only that part was sent
+        x_range = zoom
+
+    return figure_template.figure(wavelengths, intensities,
+                                  x_range, y_range, auto_range, y_title)
+
+
+# the whole waterfall is only sent when the page is loaded and when the
+# calibration changes; rows completed in between are appended in the
+# browser (see update_waterfall_rows)
+@fast_json_callback(
+    app,
+    Output('waterfall', 'figure'),
+    inputs=[
+        Input('refresh-check-interval', 'n_intervals')
     ],
     state=[
-        State('power-button', 'on'),
-        State('autoscale-switch', 'on')
+        State('session-id', 'children')
     ]
 )
-def update_plot(_, on, auto_range):
+def update_waterfall(_, session_id):
+    if not delivered_frames.update(session_id + '-waterfall',
+                                   spec.waterfall_generation()):
+        raise PreventUpdate
+    return waterfall_figure(spec.waterfall_rows(), WATERFALL_ROW_PERIOD,
+                            figure_template.colors())
 
-    traces = []
-    wavelengths = []
-    intensities = []
 
-    x_axis = {
-            'title': 'Wavelength (nm)',
-            'titlefont': {
-                'family': 'Helvetica, sans-serif',
-                'color': colors['secondary']
-            },
-            'tickfont': {
-                'color': colors['tertiary']
-            },
-            'dtick': 100,
-            'color': colors['secondary'],
-            'gridcolor': colors['grid-colour']
-    }
-    y_axis = {
-        'title': 'Intensity (AU)',
-        'titlefont': {
-            'family': 'Helvetica, sans-serif',
-            'color': colors['secondary']
-        },
-        'tickfont': {
-            'color': colors['tertiary']
-        },
-        'color': colors['secondary'],
-        'gridcolor': colors['grid-colour'],
-    }
-    
-    if(on):
-        spectrum = spec.get_spectrum()
-        wavelengths = spectrum[0]
-        intensities = spectrum[1]
-    else:
-        wavelengths = numpy.linspace(400, 900, 5000)
-        intensities = [0 for wl in wavelengths]
-
-    if(on):
-        if(auto_range):
-            x_axis['range'] = [
-                min(wavelengths),
-                max(wavelengths)
-            ]
-            y_axis['range'] = [
-                min(intensities),
-                max(intensities)
-            ]
-    traces.append(go.Scatter(
-        x=wavelengths,
-        y=intensities,
-        name='Spectrometer readings',
-        mode='lines',
-        line={
-            'width': 1,
-            'color': colors['accent']
-        }
-    ))
-
-    layout = go.Layout(
-        height=600,
-        font={
-            'family': 'Helvetica Neue, sans-serif',
-            'size': 12
-        },
-        margin={
-            't': 20
-        },
-        titlefont={
-            'family': 'Helvetica, sans-serif',
-            'color': colors['primary'],
-            'size': 26
-        },
-        xaxis=x_axis,
-        yaxis=y_axis,
-        paper_bgcolor=colors['background'],
-        plot_bgcolor=colors['background'],
-    )
+# rows completed since the ones last sent to this page, which
+# assets/waterfall.js appends to the waterfall
+@app.callback(
+    Output('waterfall-rows', 'children'),
+    [Input('refresh-check-interval', 'n_intervals')],
+    [State('waterfall-rows', 'children')]
+)
+def update_waterfall_rows(_, sent):
+    rows = new_waterfall_rows(spec, sent)
+    if(len(rows[2]) == 0):
+        raise PreventUpdate
+    return waterfall_rows_json(rows, WATERFALL_ROWS, WATERFALL_ROW_PERIOD)
+
 
-    return {'data': traces,
-            'layout': layout}
+# table of the peaks of the newest frame and the tracked bands; only
+# rebuilt when there is a new frame
+@app.callback(
+    Output('peak-table', 'children'),
+    [Input('spec-reading-interval', 'n_intervals'),
+     Input('power-button', 'on')],
+    state=[State('session-id', 'children')]
+)
+def update_peak_table(_, on, session_id):
+    frame = spec.latest_frame() if on else None
+    seq = frame.seq if frame is not None else None
+    if not delivered_frames.update(session_id + '-peaks', seq):
+        raise PreventUpdate
+    if(frame is None):
+        return []
+
+    header = html.Tr([html.Th(name) for name in
+                      ["", "position (nm)", "height", "FWHM (nm)",
+                       "centroid (nm)"]])
+    rows = [html.Tr([html.Td("peak %d" % (i + 1)),
+                     html.Td("%.2f" % peak['position']),
+                     html.Td("%.4g" % peak['height']),
+                     html.Td("%.2f" % peak['fwhm']),
+                     html.Td("%.2f" % peak['centroid'])])
+            for i, peak in enumerate(peak_finder.peaks(frame))]
+
+    bands = spec.latest_bands() or {}
+    rows += [html.Tr([html.Td(name),
+                      html.Td("%.2f" % values['position']),
+                      html.Td("%.4g" % values['height']),
+                      html.Td(""),
+                      html.Td("%.2f" % values['centroid'])])
+             for name, values in bands.items()]
+    return html.Table([header] + rows)
 
 
 ############################
@@ -0,0 +1,58 @@
+// appends the rows of the waterfall plot as they are completed, so that
+// the server only sends the whole heatmap when the page is loaded or the
+// calibration changes; the rows arrive in the hidden #waterfall-rows div
+// (see update_waterfall_rows in app.py) and the oldest rows are dropped
+// as new ones arrive
+(function () {
+    // rows received most recently, in case they arrive before the figure
+    // they are to be added to
+    var RECENT_ROWS = 10;
+    var recent = [];
+    var keep = 0;
+    var received = null;
+
+    function append() {
+        // dcc.Graph plots into the #waterfall div itself
+        var gd = document.getElementById('waterfall');
+        if (!gd || !gd.data || gd.data.length === 0 || !window.Plotly) {
+            return;
+        }
+        var trace = gd.data[0];
+        var y = trace.y || [];
+        var last = y.length > 0 ? y[y.length - 1] : '';
+        var times = [];
+        var values = [];
+        recent.forEach(function (row) {
+            // rows of another calibration wait for the next figure
+            if (row.t > last && trace.x && row.z.length === trace.x.length) {
+                times.push(row.t);
+                values.push(row.z);
+                last = row.t;
+            }
+        });
+        if (times.length > 0) {
+            window.Plotly.extendTraces(gd, {y: [times], z: [values]}, [0],
+                                       keep);
+        }
+    }
+
+    function receive() {
+        var div = document.getElementById('waterfall-rows');
+        var text = div ? div.textContent : '';
+        if (text && text !== received) {
+            received = text;
+            var update = JSON.parse(text);
+            keep = update.keep;
+            recent = recent.concat(update.rows).slice(-RECENT_ROWS);
+        }
+        // also when a new figure has been drawn
+        append();
+    }
+
+    // the div is rendered, and its text replaced, by Dash
+    new MutationObserver(receive).observe(document.body, {
+        childList: true,
+        characterData: true,
+        subtree: true
+    });
+})();
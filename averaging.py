@@ -0,0 +1,134 @@
+import numpy
+
+# 'none', rolling mean over a number of frames, or exponential moving
+# average with the same effective number of frames
+AVERAGING_MODES = ('none', 'rolling', 'ema')
+
+
+# how a frame taken with the given control values was averaged: the
+# mode, the number of frames averaged (1 without averaging) and the
+# boxcar width, with SpectrumAverager's defaults for controls never set
+def averaging_of(settings):
+    settings = settings or {}
+    mode = str(settings.get('averaging-mode-input', 'none'))
+    try:
+        frames = int(float(settings.get('averaging-frames-input', 10)))
+        boxcar = int(float(settings.get('boxcar-width-input', 1)))
+    except (TypeError, ValueError):
+        frames, boxcar = 0, 0
+    if mode == 'none':
+        frames = 1
+    return mode, frames, boxcar
+
+
+# mean of the last frames spectra; the running sum is updated by adding
+# the newest spectrum and subtracting the one that drops out, so every
+# spectrum costs O(pixels) whatever the number of frames
+class RollingMean:
+
+    def __init__(self, frames, pixels):
+        self._history = numpy.zeros((frames, pixels))
+        self._sum = numpy.zeros(pixels)
+        self._count = 0                    # spectra added so far
+
+    def add(self, intensities):
+        frames = len(self._history)
+        row = self._history[self._count % frames]
+        self._sum -= row
+        row[:] = intensities
+        self._sum += row
+        self._count += 1
+        # rounding errors build up in the running sum; start it afresh
+        # every now and then
+        if self._count % (frames * 100) == 0:
+            self._history.sum(axis=0, out=self._sum)
+        return self._sum / min(self._count, frames)
+
+
+# exponential moving average; alpha is the weight of the newest spectrum
+class ExponentialMean:
+
+    def __init__(self, alpha, pixels):
+        self._alpha = alpha
+        self._mean = numpy.zeros(pixels)
+        self._delta = numpy.zeros(pixels)
+        self._started = False
+
+    def add(self, intensities):
+        if not self._started:
+            self._mean[:] = intensities
+            self._started = True
+        else:
+            numpy.subtract(intensities, self._mean, out=self._delta)
+            self._delta *= self._alpha
+            self._mean += self._delta
+        return self._mean.copy()
+
+
+# mean over a window of width pixels centred on each pixel (narrower at
+# the ends of the spectrum), computed from a cumulative sum
+class Boxcar:
+
+    def __init__(self, width, pixels):
+        half = width // 2
+        pixel = numpy.arange(pixels)
+        self._lo = numpy.maximum(pixel - half, 0)
+        self._hi = numpy.minimum(pixel + half + 1, pixels)
+        self._counts = (self._hi - self._lo).astype(numpy.float64)
+        self._cumsum = numpy.zeros(pixels + 1)
+
+    def apply(self, intensities):
+        numpy.cumsum(intensities, out=self._cumsum[1:])
+        return (self._cumsum[self._hi] - self._cumsum[self._lo]) / \
+            self._counts
+
+
+# host-side averaging of acquired spectra, so that short integration
+# times can be used while still showing a low-noise spectrum; applied by
+# the acquisition thread to every spectrum before it is published
+#
+# the accumulators are allocated for the first spectrum and start again
+# whenever the number of pixels or the device settings change
+class SpectrumAverager:
+
+    def __init__(self, mode='none', frames=10, boxcar=1):
+        if mode not in AVERAGING_MODES:
+            raise ValueError("Unknown averaging mode %s." % mode)
+        if int(frames) < 1 or int(boxcar) < 1:
+            raise ValueError("Averaging needs at least one frame and pixel.")
+        self._mode = mode
+        self._frames = int(frames)
+        self._boxcar_width = int(boxcar)
+        self._pixels = None
+        self._settings = None
+        self._mean = None
+        self._boxcar = None
+
+    # whether spectra are changed at all
+    def active(self):
+        return self._mode != 'none' or self._boxcar_width > 1
+
+    def _reset(self, pixels):
+        self._pixels = pixels
+        self._mean = None
+        if self._mode == 'rolling':
+            self._mean = RollingMean(self._frames, pixels)
+        elif self._mode == 'ema':
+            self._mean = ExponentialMean(2.0 / (self._frames + 1), pixels)
+        self._boxcar = (Boxcar(self._boxcar_width, pixels)
+                        if self._boxcar_width > 1 else None)
+
+    # averaged copy of intensities; settings are the device settings the
+    # spectrum was taken with
+    def add(self, intensities, settings=None):
+        if not self.active():
+            return intensities
+        if len(intensities) != self._pixels or settings is not self._settings:
+            self._reset(len(intensities))
+            self._settings = settings
+
+        if self._mean is not None:
+            intensities = self._mean.add(intensities)
+        if self._boxcar is not None:
+            intensities = self._boxcar.apply(intensities)
+        return intensities
@@ -0,0 +1,159 @@
+import numpy
+
+
+# indices [lo, hi) of the points of the sorted array x that fall inside
+# xRange, widened by margin (a fraction of the range) on either side;
+# None means the whole array
+def visible_slice(x, xRange=None, margin=0.0):
+    if xRange is None:
+        return 0, len(x)
+    x0, x1 = min(xRange), max(xRange)
+    pad = (x1 - x0) * margin
+    lo = int(numpy.searchsorted(x, x0 - pad, side='left'))
+    hi = int(numpy.searchsorted(x, x1 + pad, side='right'))
+    return max(lo - 1, 0), min(hi + 1, len(x))
+
+
+# splits n points into buckets of equal size; returns the bucket size,
+# or 0 if the points do not need reducing
+def _bucket_size(n, buckets):
+    if buckets <= 0 or n <= 2 * buckets:
+        return 0
+    return -(-n // buckets)
+
+
+# y padded with its last value and split into rows of equal size
+def _buckets(y, buckets, size):
+    n = len(y)
+    padded = numpy.empty(buckets * size, dtype=y.dtype)
+    padded[:n] = y
+    padded[n:] = y[-1]
+    return padded.reshape(buckets, size)
+
+
+# reduces y to at most 2 * buckets points by keeping the minimum and
+# maximum of each bucket, in their original order, so that no peak is
+# lost; returns the indices of the points to keep
+def minmax_indices(y, buckets):
+    n = len(y)
+    size = _bucket_size(n, buckets)
+    if size == 0:
+        return numpy.arange(n)
+    # rounding the size up can leave whole buckets of padding; drop them
+    buckets = -(-n // size)
+
+    padded = _buckets(y, buckets, size)
+    offsets = numpy.arange(buckets) * size
+    imin = offsets + padded.argmin(axis=1)
+    imax = offsets + padded.argmax(axis=1)
+    indices = numpy.sort(numpy.stack([imin, imax], axis=1), axis=1).ravel()
+    return numpy.minimum(indices, n - 1)
+
+
+# like minmax_indices, but the two points of each bucket are placed at
+# the bucket's first and last x instead of where the minimum and maximum
+# lie, so that x only depends on the calibration and the number of
+# buckets; the values are still in their original order, and the shift
+# is smaller than a bucket (about one pixel)
+def minmax_fixed_x(x, y, buckets):
+    n = len(y)
+    size = _bucket_size(n, buckets)
+    if size == 0:
+        return x, y
+    buckets = -(-n // size)
+
+    padded = _buckets(y, buckets, size)
+    argmin = padded.argmin(axis=1)
+    argmax = padded.argmax(axis=1)
+    rows = numpy.arange(buckets)
+    low = padded[rows, argmin]
+    high = padded[rows, argmax]
+    min_first = argmin <= argmax
+
+    values = numpy.empty((buckets, 2), dtype=y.dtype)
+    values[:, 0] = numpy.where(min_first, low, high)
+    values[:, 1] = numpy.where(min_first, high, low)
+
+    starts = numpy.minimum(rows * size, n - 1)
+    ends = numpy.minimum(rows * size + size - 1, n - 1)
+    positions = x[numpy.stack([starts, ends], axis=1).ravel()]
+    return positions, values.ravel()
+
+
+# largest-triangle-three-buckets: picks the point of each bucket that
+# forms the largest triangle with the point kept from the previous bucket
+# and the average of the next one; returns the indices of the points to
+# keep, including the first and last
+def lttb_indices(x, y, threshold):
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return numpy.arange(n)
+
+    edges = numpy.linspace(1, n - 1, threshold - 1).astype(int)
+    # averages of every bucket, computed at once
+    counts = numpy.diff(edges)
+    avg_x = numpy.add.reduceat(x[:n - 1], edges[:-1]) / counts
+    avg_y = numpy.add.reduceat(y[:n - 1], edges[:-1]) / counts
+    avg_x = numpy.append(avg_x, x[n - 1])
+    avg_y = numpy.append(avg_y, y[n - 1])
+
+    indices = numpy.empty(threshold, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        ax, ay = x[a], y[a]
+        area = numpy.abs((ax - avg_x[i + 1]) * (y[start:stop] - ay) -
+                         (ax - x[start:stop]) * (avg_y[i + 1] - ay))
+        a = start + int(area.argmax())
+        indices[i + 1] = a
+    return indices
+
+
+# reduces a spectrum to roughly the number of points that can be shown
+# in widthPx pixels, only keeping what lies in (or near) xRange; method
+# is 'minmax' or 'lttb'
+def decimate(x, y, widthPx, xRange=None, method='minmax'):
+    x = numpy.asarray(x)
+    y = numpy.asarray(y)
+    lo, hi = visible_slice(x, xRange, margin=0.25)
+    x = x[lo:hi]
+    y = y[lo:hi]
+    if method == 'lttb':
+        indices = lttb_indices(x, y, 2 * widthPx)
+    else:
+        indices = minmax_indices(y, widthPx)
+    return x[indices], y[indices]
+
+
+# decimates frame after frame; with the 'minmax' method the x values only
+# change with the calibration, the range or the width, and while they
+# stay the same the very same x array is returned, so that its encoding
+# can be cached by identity
+class Decimator:
+
+    def __init__(self, widthPx, method='minmax'):
+        self._width = widthPx
+        self._method = method
+        # calibration, visible slice and decimated x of the last frame;
+        # one tuple so that concurrent callbacks never see a mix
+        self._last = (None, None, None)
+
+    def decimate(self, x, y, xRange=None):
+        if self._method != 'minmax':
+            return decimate(x, y, self._width, xRange, self._method)
+
+        x = numpy.asarray(x)
+        y = numpy.asarray(y)
+        lo, hi = visible_slice(x, xRange, margin=0.25)
+        positions, values = minmax_fixed_x(x[lo:hi], y[lo:hi], self._width)
+
+        source, key, last_x = self._last
+        same_x = (x is source or
+                  (source is not None and numpy.array_equal(x, source)))
+        if same_x and key == (lo, hi):
+            return last_x, values
+
+        self._last = (x, (lo, hi), positions)
+        return positions, values
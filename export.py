@@ -0,0 +1,240 @@
+import io
+import os
+import time
+import zipfile
+
+import flask
+import numpy
+from numpy.lib import format as npformat
+
+from averaging import averaging_of
+from recording import RecordingReader
+
+# frames converted and sent at a time
+EXPORT_BATCH = 64
+
+
+# frames in the ring buffer taken between start and end, as (seq,
+# timestamp, wavelengths, intensities, averaging), where averaging is the
+# mode, frames and boxcar width of averaging_of; the buffer is only locked
+# to take a snapshot, whose frames stay valid however long the download
+# takes
+def buffered_frames(spec, start=None, end=None):
+    frames = [f for f in spec.frames()
+              if (start is None or f.timestamp >= start) and
+              (end is None or f.timestamp <= end)]
+
+    def generate():
+        for f in frames:
+            yield (f.seq, f.timestamp, f.wavelengths, f.intensities,
+                   averaging_of(f.settings))
+
+    return len(frames), generate()
+
+
+# frames of a recording taken between start and end, in the same form;
+# they are paged in from disk one at a time
+def recorded_frames(directory, start=None, end=None):
+    recording = RecordingReader(directory)
+    timestamps = recording.timestamps()
+    first = 0 if start is None else recording.find(start)
+    last = (len(recording) if end is None else
+            int(numpy.searchsorted(timestamps, end, side='right')))
+
+    def generate():
+        for position in range(first, last):
+            wavelengths, intensities, entry = recording.frame(position)
+            yield (int(entry['seq']), float(entry['timestamp']),
+                   wavelengths, intensities,
+                   (entry['averaging'].decode(),
+                    int(entry['averaged_frames']), int(entry['boxcar'])))
+
+    return max(last - first, 0), generate()
+
+
+# CSV with one row per frame: sequence number, timestamp, averaging mode,
+# frames averaged, boxcar width and intensities; the first row, and
+# another one whenever the calibration changes, holds the wavelengths
+def csv_stream(frames):
+    wavelengths = None
+    batch = []
+
+    def rows(batch):
+        out = io.StringIO()
+        table = numpy.empty((len(batch), len(batch[0][3])))
+        for i, frame in enumerate(batch):
+            table[i] = frame[3]
+        numpy.savetxt(out, table, delimiter=',', fmt='%.7g')
+        return ''.join(
+            '%d,%.6f,%s,%d,%d,%s\n' % ((seq, timestamp) + averaging +
+                                       (line,))
+            for (seq, timestamp, _, _, averaging), line in
+            zip(batch, out.getvalue().splitlines()))
+
+    for frame in frames:
+        frame_wavelengths = frame[2]
+        if frame_wavelengths is not wavelengths and \
+           (wavelengths is None or
+            not numpy.array_equal(frame_wavelengths, wavelengths)):
+            if len(batch) > 0:
+                yield rows(batch)
+                batch = []
+            yield ('seq,timestamp,averaging,averaged_frames,boxcar,' +
+                   ','.join('%.10g' % w for w in frame_wavelengths) + '\n')
+        wavelengths = frame_wavelengths
+        batch.append(frame)
+        if len(batch) >= EXPORT_BATCH:
+            yield rows(batch)
+            batch = []
+
+    if len(batch) > 0:
+        yield rows(batch)
+
+
+# collects what zipfile writes, to be handed out in pieces; having no
+# tell() makes zipfile write the archive without seeking back
+class _ChunkWriter:
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        return
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _npy_header(archive, name, dtype, shape):
+    member = archive.open(name, 'w', force_zip64=True)
+    npformat.write_array_header_1_0(member, {
+        'descr': npformat.dtype_to_descr(numpy.dtype(dtype)),
+        'fortran_order': False,
+        'shape': shape
+    })
+    return member
+
+
+# .npz archive of count frames holding seq, timestamps, averaging,
+# averaged_frames, boxcar (see averaging_of), wavelengths and intensities
+# (count x pixels, float32), written as it is sent; the
+# wavelengths are those of the first frame, and frames with a different
+# number of pixels are filled with nan
+def npz_stream(count, frames):
+    out = _ChunkWriter()
+    seqs = numpy.zeros(count, dtype=numpy.int64)
+    timestamps = numpy.zeros(count)
+    modes = numpy.zeros(count, dtype='U8')
+    averaged_frames = numpy.zeros(count, dtype=numpy.int32)
+    boxcars = numpy.zeros(count, dtype=numpy.int32)
+    wavelengths = None
+
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED) as archive:
+        member = None
+        for i, (seq, timestamp, frame_wavelengths, intensities,
+                averaging) in enumerate(frames):
+            if i >= count:
+                break
+            if member is None:
+                wavelengths = numpy.asarray(frame_wavelengths)
+                member = _npy_header(archive, 'intensities.npy',
+                                     numpy.float32,
+                                     (count, len(wavelengths)))
+            row = numpy.full(len(wavelengths), numpy.nan,
+                             dtype=numpy.float32)
+            if len(intensities) == len(row):
+                row[:] = intensities
+            member.write(row.tobytes())
+            seqs[i] = seq
+            timestamps[i] = timestamp
+            modes[i], averaged_frames[i], boxcars[i] = averaging
+            if i % EXPORT_BATCH == 0:
+                yield out.drain()
+
+        if member is None:
+            wavelengths = numpy.zeros(0)
+            member = _npy_header(archive, 'intensities.npy',
+                                 numpy.float32, (0, 0))
+        member.close()
+
+        for name, values in (('seq.npy', seqs),
+                             ('timestamps.npy', timestamps),
+                             ('averaging.npy', modes),
+                             ('averaged_frames.npy', averaged_frames),
+                             ('boxcar.npy', boxcars),
+                             ('wavelengths.npy', wavelengths)):
+            with archive.open(name, 'w', force_zip64=True) as f:
+                npformat.write_array(f, values)
+        yield out.drain()
+
+    yield out.drain()
+
+
+# routes that download acquired spectra:
+#     /export/spectra.csv     see csv_stream
+#     /export/spectra.npz     see npz_stream
+#     /export/recordings      the recordings in recordingDir
+# the spectra come from the ring buffer, or from the recording given by
+# the recording query parameter; start and end (unix time) or last
+# (seconds before now) select the time range
+def export_blueprint(spec, recordingDir):
+    blueprint = flask.Blueprint('export', __name__)
+
+    def selected_frames():
+        args = flask.request.args
+        start = args.get('start', default=None, type=float)
+        end = args.get('end', default=None, type=float)
+        last = args.get('last', default=None, type=float)
+        if last is not None:
+            start = time.time() - last
+        name = args.get('recording')
+        if name is None:
+            return buffered_frames(spec, start, end)
+        if name != os.path.basename(name) or name in ('', '.', '..'):
+            flask.abort(404)
+        directory = os.path.join(recordingDir, name)
+        if not os.path.isdir(directory):
+            flask.abort(404)
+        return recorded_frames(directory, start, end)
+
+    def download(name):
+        return {'Content-Disposition': 'attachment; filename=%s' % name,
+                'X-Accel-Buffering': 'no'}
+
+    @blueprint.route('/export/spectra.csv')
+    def export_csv():
+        _, frames = selected_frames()
+        return flask.Response(csv_stream(frames), mimetype='text/csv',
+                              headers=download('spectra.csv'))
+
+    @blueprint.route('/export/spectra.npz')
+    def export_npz():
+        count, frames = selected_frames()
+        return flask.Response(npz_stream(count, frames),
+                              mimetype='application/octet-stream',
+                              headers=download('spectra.npz'))
+
+    @blueprint.route('/export/recordings')
+    def list_recordings():
+        recordings = []
+        if os.path.isdir(recordingDir):
+            for name in sorted(os.listdir(recordingDir)):
+                directory = os.path.join(recordingDir, name)
+                if not os.path.isdir(directory):
+                    continue
+                timestamps = RecordingReader(directory).timestamps()
+                recordings.append({
+                    'name': name,
+                    'frames': len(timestamps),
+                    'start': float(timestamps[0]) if len(timestamps) else None,
+                    'end': float(timestamps[-1]) if len(timestamps) else None
+                })
+        return flask.jsonify(recordings)
+
+    return blueprint
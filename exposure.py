@@ -0,0 +1,51 @@
+import numpy
+
+# saturation level assumed for devices that do not report one (16 bits)
+DEFAULT_SATURATION_LEVEL = 65535
+
+
+# picks the integration time that fills the detector to a target fraction
+# of its saturation level, from the statistics every frame already has
+#
+# counts grow about linearly with the integration time, so the time is
+# scaled by target / fill, at most maxFactor up or down per frame; a
+# saturated frame says nothing about how far over it is, so the time is
+# then cut by saturatedFactor; within tolerance (a fraction of the
+# target) the time is left alone, so that noise does not keep changing it
+class AutoExposure:
+
+    def __init__(self, target=0.8, tolerance=0.1, maxFactor=10.0,
+                 saturatedFactor=0.25):
+        if not 0 < target < 1:
+            raise ValueError("The target fill must be between 0 and 100%.")
+        self._target = target
+        self._tolerance = tolerance
+        self._max_factor = maxFactor
+        self._saturated_factor = saturatedFactor
+
+    def target(self):
+        return self._target
+
+    # integration time (us) to use after frame, which was taken with
+    # current, or None to keep it; limits are the device's minimum and
+    # maximum integration times
+    def next_integration_time(self, frame, current, saturationLevel, limits):
+        if saturationLevel is None:
+            saturationLevel = DEFAULT_SATURATION_LEVEL
+        fill = frame.max / float(saturationLevel)
+
+        if frame.saturated or fill >= 1:
+            factor = self._saturated_factor
+        elif abs(fill - self._target) <= self._tolerance * self._target:
+            return None
+        elif fill <= 0:
+            factor = self._max_factor
+        else:
+            factor = numpy.clip(self._target / fill,
+                                1.0 / self._max_factor, self._max_factor)
+
+        low, high = limits
+        new = int(round(numpy.clip(current * factor, low, high)))
+        if new == int(round(current)):
+            return None
+        return new
@@ -0,0 +1,246 @@
+import os
+import json
+import time
+
+import flask
+import numpy
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# JSON that has already been encoded; inserted into the output verbatim,
+# so static parts of a figure only have to be encoded once
+class RawJSON:
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    @classmethod
+    def encode(cls, obj):
+        return cls(dumps(obj))
+
+
+# JSON array for a sequence of floats; precision is the number of
+# significant digits to keep (None keeps full precision), and values that
+# are not finite become null
+def encode_floats(values, precision=None):
+    a = numpy.asarray(values, dtype=numpy.float64)
+    if precision is not None:
+        a = _round_significant(a, precision)
+
+    if orjson is not None:
+        # float32 keeps ~7 digits and orjson writes its shortest form
+        if precision is not None and precision <= 7:
+            a = a.astype(numpy.float32)
+        return orjson.dumps(numpy.ascontiguousarray(a),
+                            option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    finite = numpy.isfinite(a)
+    if not finite.all():
+        a = a.astype(object)
+        a[~finite] = None
+    return json.dumps(a.tolist(), separators=(',', ':'))
+
+
+def _round_significant(a, precision):
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        magnitude = numpy.floor(numpy.log10(numpy.abs(a)))
+    magnitude[~numpy.isfinite(magnitude)] = 0
+    scale = 10.0 ** (precision - 1 - magnitude)
+    return numpy.round(a * scale) / scale
+
+
+# encodes a figure made of dicts, lists, strings, numbers, numpy arrays
+# and RawJSON; arrays go through encode_floats with the given precision
+def dumps(obj, precision=None):
+    if isinstance(obj, RawJSON):
+        return obj.text
+    if isinstance(obj, numpy.ndarray):
+        return encode_floats(obj, precision)
+    if isinstance(obj, dict):
+        return '{' + ','.join(
+            json.dumps(str(k)) + ':' + dumps(v, precision)
+            for k, v in obj.items()
+        ) + '}'
+    if isinstance(obj, (list, tuple)):
+        return '[' + ','.join(dumps(v, precision) for v in obj) + ']'
+    if isinstance(obj, numpy.generic):
+        obj = obj.item()
+    if isinstance(obj, float) and not numpy.isfinite(obj):
+        return 'null'
+    return json.dumps(obj)
+
+
+# registers a callback like app.callback, but encodes its return value
+# with dumps() instead of the generic plotly JSON encoder
+def fast_json_callback(app, output, inputs=[], state=[], precision=None):
+    def wrap_func(func):
+        app.callback(output, inputs, state)(func)
+        prop = json.dumps(output.component_property)
+
+        def respond(*args, **kwargs):
+            body = '{"response":{"props":{%s:%s}}}' % (
+                prop, dumps(func(*args, **kwargs), precision))
+            return flask.Response(body, mimetype='application/json')
+
+        callback_id = '{}.{}'.format(output.component_id,
+                                     output.component_property)
+        app.callback_map[callback_id]['callback'] = respond
+        return func
+    return wrap_func
+
+
+# reads colors.txt; each line is "<name> <colour>"
+def load_colors(path):
+    colors = {}
+    with open(path, 'r') as f:
+        for line in f.readlines():
+            colors[line.split(' ')[0]] = line.split(' ')[1].strip('\n')
+    return colors
+
+
+# figure for the live spectrum; the layout and trace styling are built
+# and encoded once, and rebuilt only when the colours file changes or the
+# autoscale mode or the y-axis title switches, so that each frame only
+# costs encoding the trace data and splicing in the axis ranges
+class SpectrumFigureTemplate:
+
+    def __init__(self, colorsFile, precision=None, checkInterval=1.0):
+        self._colors_file = colorsFile
+        self._precision = precision
+        self._check_interval = checkInterval  # between colours checks (s)
+        self._checked = 0.0
+        self._mtime = None
+        self._colors = {}
+        self._parts = {}      # (autoscale, y-axis title) -> encoded parts
+        self._empty = None
+        self._x = (None, None)                 # last x array and its JSON
+
+    # current colours; reloaded if the file has changed
+    def colors(self):
+        now = time.time()
+        if now - self._checked >= self._check_interval:
+            self._checked = now
+            mtime = os.stat(self._colors_file).st_mtime
+            if mtime != self._mtime:
+                self._mtime = mtime
+                self._colors = load_colors(self._colors_file)
+                self.invalidate()
+        return self._colors
+
+    def invalidate(self):
+        self._parts = {}
+        self._empty = None
+
+    def _axes(self, colors, yTitle):
+        x_axis = {
+            'title': 'Wavelength (nm)',
+            'titlefont': {
+                'family': 'Helvetica, sans-serif',
+                'color': colors['secondary']
+            },
+            'tickfont': {
+                'color': colors['tertiary']
+            },
+            'dtick': 100,
+            'color': colors['secondary'],
+            'gridcolor': colors['grid-colour']
+        }
+        y_axis = {
+            'title': yTitle,
+            'titlefont': {
+                'family': 'Helvetica, sans-serif',
+                'color': colors['secondary']
+            },
+            'tickfont': {
+                'color': colors['tertiary']
+            },
+            'color': colors['secondary'],
+            'gridcolor': colors['grid-colour'],
+        }
+        return x_axis, y_axis
+
+    # encoded pieces of the figure, with gaps left for the trace data and
+    # the axis ranges
+    def _encoded_parts(self, autoscale, yTitle):
+        colors = self.colors()
+        if (autoscale, yTitle) in self._parts:
+            return self._parts[(autoscale, yTitle)]
+
+        x_axis, y_axis = self._axes(colors, yTitle)
+        if autoscale:
+            x_axis['autorange'] = False
+            y_axis['autorange'] = False
+        layout = {
+            'height': 600,
+            'font': {
+                'family': 'Helvetica Neue, sans-serif',
+                'size': 12
+            },
+            'margin': {
+                't': 20
+            },
+            'titlefont': {
+                'family': 'Helvetica, sans-serif',
+                'color': colors['primary'],
+                'size': 26
+            },
+            'paper_bgcolor': colors['background'],
+            'plot_bgcolor': colors['background'],
+        }
+        trace_style = {
+            'type': 'scatter',
+            'name': 'Spectrometer readings',
+            'mode': 'lines',
+            'line': {
+                'width': 1,
+                'color': colors['accent']
+            }
+        }
+        parts = (
+            '{"data":[{' + dumps(trace_style)[1:-1] + ',"x":',
+            ',"y":',
+            '}],"layout":{' + dumps(layout)[1:-1] + ',"xaxis":{' +
+            dumps(x_axis)[1:-1],
+            '},"yaxis":{' + dumps(y_axis)[1:-1],
+            '}}}'
+        )
+        self._parts[(autoscale, yTitle)] = parts
+        return parts
+
+    # figure for the given spectrum; an axis range of None leaves that
+    # axis to plotly
+    def figure(self, x, y, xRange=None, yRange=None, autoscale=False,
+               yTitle='Intensity (AU)'):
+        head, y_key, x_axis, y_axis, tail = self._encoded_parts(autoscale,
+                                                                yTitle)
+
+        # the x values are usually the same array as last time
+        if x is not self._x[0]:
+            self._x = (x, encode_floats(x, self._precision))
+
+        return RawJSON(''.join([
+            head, self._x[1],
+            y_key, encode_floats(y, self._precision),
+            x_axis, _range(xRange),
+            y_axis, _range(yRange),
+            tail
+        ]))
+
+    # flat line shown while the spectrometer is off
+    def empty(self):
+        self.colors()
+        if self._empty is None:
+            self._empty = self.figure(numpy.array([400.0, 900.0]),
+                                      numpy.zeros(2))
+        return self._empty
+
+
+def _range(axisRange):
+    if axisRange is None:
+        return ''
+    return ',"range":' + dumps([float(v) for v in axisRange])
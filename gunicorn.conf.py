@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+# gunicorn settings; see Procfile
+#
+# the spectrometer can only be opened by one process, so it is owned by a
+# separate acquisition process started before the web workers; workers
+# read its frames from shared memory and send it their commands
+
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+
+# threaded workers, so that long-lived spectrum streams neither block
+# other requests nor get the worker killed for timing out
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+def on_starting(server):
+    from sharedacquisition import start_acquisition_process
+
+    # /dev/shm keeps the frames in memory on linux
+    directory = tempfile.mkdtemp(
+        prefix='spectrometer-',
+        dir='/dev/shm' if os.path.isdir('/dev/shm') else None
+    )
+    authkey = os.urandom(32)
+
+    # inherited by the workers, which pick them up in app.py
+    os.environ['SPECTROMETER_ACQUISITION_DIR'] = directory
+    os.environ['SPECTROMETER_AUTHKEY'] = authkey.hex()
+
+    server.acquisition_dir = directory
+    server.acquisition_process = start_acquisition_process(
+        directory, authkey, demo='DASH_PATH_ROUTING' in os.environ,
+        replay=os.environ.get('SPECTROMETER_REPLAY'),
+        replaySpeed=float(os.environ.get('SPECTROMETER_REPLAY_SPEED', 1.0))
+    )
+
+
+def on_exit(server):
+    server.acquisition_process.terminate()
+    server.acquisition_process.join(5)
+    shutil.rmtree(server.acquisition_dir, ignore_errors=True)
@@ -0,0 +1,63 @@
+import time
+import threading
+
+
+# how well communication with a spectrometer is going: when the last
+# spectrum was read, how many reads in a row have failed and why, how
+# often the device had to be reopened, and the last command that failed;
+# updated by whichever thread talks to the device, read by the page
+class DeviceHealth:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_frame = None          # when the last spectrum was read
+        self._consecutive_failures = 0
+        self._failures = 0
+        self._reconnect_attempts = 0
+        self._worker_restarts = 0        # device threads left hung
+        self._last_error = None
+        self._last_error_time = None
+        self._last_command_error = None  # of a settings or light command
+        self._last_command_error_time = None
+
+    def success(self):
+        with self._lock:
+            self._last_frame = time.time()
+            self._consecutive_failures = 0
+
+    # a read that failed; error is an exception or a message
+    def failure(self, error):
+        with self._lock:
+            self._consecutive_failures += 1
+            self._failures += 1
+            self._last_error = str(error) or type(error).__name__
+            self._last_error_time = time.time()
+
+    # a command that failed; reads are not affected
+    def command_failure(self, error):
+        with self._lock:
+            self._last_command_error = str(error) or type(error).__name__
+            self._last_command_error_time = time.time()
+
+    def reconnect_attempt(self):
+        with self._lock:
+            self._reconnect_attempts += 1
+
+    def worker_restart(self):
+        with self._lock:
+            self._worker_restarts += 1
+
+    # plain dict, so that it can be sent to another process
+    def snapshot(self):
+        with self._lock:
+            return {
+                'last_frame': self._last_frame,
+                'consecutive_failures': self._consecutive_failures,
+                'failures': self._failures,
+                'reconnect_attempts': self._reconnect_attempts,
+                'worker_restarts': self._worker_restarts,
+                'last_error': self._last_error,
+                'last_error_time': self._last_error_time,
+                'last_command_error': self._last_command_error,
+                'last_command_error_time': self._last_command_error_time
+            }
@@ -0,0 +1,255 @@
+import threading
+
+import flask
+import numpy
+
+from figures import dumps
+
+
+# x at which y crosses level between points i and j, by linear
+# interpolation
+def _crossing(x, y, i, j, level):
+    if y[j] == y[i]:
+        return x[i]
+    return x[i] + (level - y[i]) * (x[j] - x[i]) / (y[j] - y[i])
+
+
+# how far each of the candidates (local maxima, in order of position)
+# rises above the higher of the lowest points between it and the nearest
+# higher point on either side (or the end of the spectrum); a bump of
+# noise on the flank of a peak has a prominence of about the noise
+#
+# the nearest higher point is on the flank of a higher candidate, whose
+# way down to it stays above it, so the bases are the nearest higher
+# candidates, found in one pass each way
+def _prominences(y, candidates):
+    heights = y[candidates].tolist()
+    positions = candidates.tolist()
+    m = len(positions)
+    left = [0] * m
+    right = [len(y) - 1] * m
+    for bases, ks in ((left, range(m)), (right, range(m - 1, -1, -1))):
+        stack = []
+        for k in ks:
+            while stack and heights[stack[-1]] <= heights[k]:
+                stack.pop()
+            if stack:
+                bases[k] = positions[stack[-1]]
+            stack.append(k)
+
+    # lowest point of [left, candidate] and of [candidate, right]
+    bounds = numpy.empty(4 * m, dtype=numpy.intp)
+    bounds[0::4] = left
+    bounds[1::4] = candidates + 1
+    bounds[2::4] = candidates
+    bounds[3::4] = numpy.add(right, 1)
+    lows = numpy.minimum.reduceat(numpy.append(y, y[-1]), bounds)
+    return y[candidates] - numpy.maximum(lows[0::4], lows[2::4])
+
+
+# peaks of the spectrum (x, y) that rise at least minHeight (a fraction of
+# the spectrum's range) above its minimum and stand out by at least
+# minProminence (a fraction of the range, minHeight if None) from their
+# surroundings, highest first, at most maxPeaks of them; each is a dict
+# with its position, height (above the minimum), full width at half
+# maximum and centroid (the mean position, weighted by height, of the
+# pixels above half maximum)
+def find_peaks(x, y, minHeight=0.1, maxPeaks=10, minProminence=None):
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    n = len(y)
+    if n < 3:
+        return []
+    baseline = y.min()
+    span = y.max() - baseline
+    if not numpy.isfinite(span) or span <= 0:
+        return []
+
+    # local maxima (the first pixel of a flat top), high enough
+    middle = y[1:-1]
+    candidates = numpy.flatnonzero(
+        (middle > y[:-2]) & (middle >= y[2:]) &
+        (middle - baseline >= minHeight * span)) + 1
+    if len(candidates) == 0:
+        return []
+    if minProminence is None:
+        minProminence = minHeight
+    candidates = candidates[_prominences(y, candidates) >=
+                            minProminence * span]
+    order = numpy.argsort(y[candidates])[::-1]
+
+    peaks = []
+    covered = numpy.zeros(n, dtype=bool)
+    for i in candidates[order]:
+        # a lower maximum on the shoulder of a peak already found
+        if covered[i]:
+            continue
+        height = y[i] - baseline
+        half = baseline + height / 2
+        below = y < half
+        left = numpy.flatnonzero(below[:i])
+        right = numpy.flatnonzero(below[i:])
+        lo = left[-1] if len(left) else 0
+        hi = i + right[0] if len(right) else n - 1
+        covered[lo:hi + 1] = True
+
+        x_left = _crossing(x, y, lo, lo + 1, half) if len(left) else x[0]
+        x_right = _crossing(x, y, hi - 1, hi, half) if len(right) else x[-1]
+        weights = y[lo + 1:hi] - baseline
+        total = weights.sum()
+        peaks.append({
+            'position': float(x[i]),
+            'height': float(height),
+            'fwhm': float(x_right - x_left),
+            'centroid': float(numpy.dot(weights, x[lo + 1:hi]) / total
+                              if total > 0 else x[i])
+        })
+        if len(peaks) >= maxPeaks:
+            break
+    return peaks
+
+
+# peaks of the newest frame; worked out once per frame, so that polls
+# that see the same frame again reuse them
+class PeakFinder:
+
+    def __init__(self, minHeight=0.1, maxPeaks=10):
+        self._min_height = minHeight
+        self._max_peaks = maxPeaks
+        self._peaks = (None, [])               # seq and peaks of a frame
+
+    def peaks(self, frame):
+        seq, peaks = self._peaks
+        if seq == frame.seq:
+            return peaks
+        peaks = find_peaks(frame.wavelengths, frame.intensities,
+                           self._min_height, self._max_peaks)
+        self._peaks = (frame.seq, peaks)
+        return peaks
+
+
+# follows a few wavelength bands over time; for every frame each band's
+# peak position, height, centroid and integral are worked out from its
+# slice of the spectrum and stored in preallocated arrays holding the
+# last history frames
+#
+# frames are added by the acquisition thread (see add), in the process
+# that acquires them, so that no frame is missed and every web worker
+# sees the same series
+class PeakTracker:
+
+    def __init__(self, bands, history=3600):
+        self._bands = list(bands)              # (name, low, high) in nm
+        self._history = history
+        self._lock = threading.Lock()
+        count = len(self._bands)
+        self._timestamps = numpy.full(history, numpy.nan)
+        self._series = {
+            name: numpy.full((history, count), numpy.nan)
+            for name in ('position', 'height', 'centroid', 'integral')
+        }
+        self._count = 0                        # frames added so far
+        self._slices = (None, [])              # calibration, band slices
+
+    def band_names(self):
+        return [band[0] for band in self._bands]
+
+    def _band_slices(self, wavelengths):
+        calibration, slices = self._slices
+        if wavelengths is calibration:
+            return slices
+        slices = [slice(int(numpy.searchsorted(wavelengths, low)),
+                        int(numpy.searchsorted(wavelengths, high,
+                                               side='right')))
+                  for _, low, high in self._bands]
+        self._slices = (wavelengths, slices)
+        return slices
+
+    # add a newly acquired frame; called by the acquisition thread
+    def add(self, frame):
+        with self._lock:
+            self._add(frame)
+
+    def _add(self, frame):
+        x = frame.wavelengths
+        y = frame.intensities
+        row = self._count % self._history
+        self._timestamps[row] = frame.timestamp
+        for b, band in enumerate(self._band_slices(x)):
+            bx = x[band]
+            by = numpy.asarray(y[band], dtype=numpy.float64)
+            if len(by) < 2:
+                for values in self._series.values():
+                    values[row, b] = numpy.nan
+                continue
+            i = int(by.argmax())
+            # above the band's lowest point, so that the baseline does
+            # not pull the centroid to the middle of the band
+            above = by - by.min()
+            area = above.sum()
+            self._series['position'][row, b] = bx[i]
+            self._series['height'][row, b] = by[i]
+            self._series['centroid'][row, b] = (
+                numpy.dot(above, bx) / area if area > 0 else bx[i])
+            self._series['integral'][row, b] = numpy.dot(
+                (by[1:] + by[:-1]) / 2, numpy.diff(bx))
+        self._count += 1
+
+    # band values of the frames taken since the given time, oldest first:
+    # the timestamps, and per band a dict of position, height, centroid
+    # and integral
+    def series(self, since=None):
+        with self._lock:
+            stored = min(self._count, self._history)
+            order = (numpy.arange(self._count - stored, self._count) %
+                     self._history)
+            timestamps = self._timestamps[order]
+            values = {name: series[order]
+                      for name, series in self._series.items()}
+        keep = (slice(None) if since is None else
+                timestamps >= since)
+        bands = {}
+        for b, name in enumerate(self.band_names()):
+            bands[name] = {key: values[key][keep, b]
+                           for key in values}
+        return timestamps[keep], bands
+
+    # the newest value of every band, or None before the first frame
+    def latest(self):
+        with self._lock:
+            if self._count == 0:
+                return None
+            row = (self._count - 1) % self._history
+            return {name: {key: float(series[row, b])
+                           for key, series in self._series.items()}
+                    for b, name in enumerate(self.band_names())}
+
+
+# routes that give the analysis results as JSON:
+#     /analysis/peaks   peaks of the newest frame
+#     /analysis/bands   band values over time; since (unix time) limits
+#                       them to recent frames
+def analysis_blueprint(spec, finder):
+    blueprint = flask.Blueprint('analysis', __name__)
+
+    @blueprint.route('/analysis/peaks')
+    def latest_peaks():
+        frame = spec.latest_frame()
+        if frame is None:
+            return flask.Response('null', mimetype='application/json')
+        return flask.Response(dumps({
+            'seq': frame.seq,
+            'timestamp': frame.timestamp,
+            'peaks': finder.peaks(frame)
+        }), mimetype='application/json')
+
+    @blueprint.route('/analysis/bands')
+    def band_series():
+        since = flask.request.args.get('since', default=None, type=float)
+        timestamps, bands = spec.band_series(since)
+        return flask.Response(dumps({
+            'timestamps': timestamps,
+            'bands': bands
+        }), mimetype='application/json')
+
+    return blueprint
@@ -0,0 +1,198 @@
+import os
+import glob
+import time
+import threading
+
+import numpy
+from numpy.lib.format import open_memmap
+
+from averaging import averaging_of
+
+# one row per recorded frame; rows that have not been written yet have a
+# sequence number of 0
+INDEX_DTYPE = numpy.dtype([
+    ('seq', '<i8'),
+    ('timestamp', '<f8'),
+    ('integration_time', '<f8'),    # microseconds; nan if unknown
+    ('scans', '<i4'),               # scans averaged; 0 if unknown
+    ('saturated', '?'),
+    ('averaging', 'S8'),            # host-side averaging mode
+    ('averaged_frames', '<i4'),     # at most; 1 without averaging
+    ('boxcar', '<i4')               # boxcar width (pixels); 1 if none
+])
+
+
+# control values may arrive as strings from the page
+def _number(value, default):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def chunk_paths(directory, number):
+    prefix = os.path.join(directory, 'chunk-%05d' % number)
+    return (prefix + '.wavelengths.npy', prefix + '.intensities.npy',
+            prefix + '.index.npy')
+
+
+# numbers of the chunks in a recording, in order
+def chunk_numbers(directory):
+    paths = glob.glob(os.path.join(directory, 'chunk-*.index.npy'))
+    return sorted(int(os.path.basename(p)[6:11]) for p in paths)
+
+
+# appends frames to a recording on disk
+#
+# a recording is a directory of chunks; each chunk is a set of .npy files
+# holding the wavelengths, a preallocated (chunkFrames x pixels) matrix of
+# intensities and an index of sequence numbers, timestamps and settings,
+# all memory-mapped so that recording a frame is a copy into the page
+# cache rather than a write of Python objects; a new chunk is started
+# when the current one is full, older than chunkSeconds, or the
+# calibration changes
+class SpectrumRecorder:
+
+    def __init__(self, directory, chunkFrames=1000, chunkSeconds=None,
+                 dtype='float32'):
+        self._directory = directory
+        self._chunk_frames = chunkFrames
+        self._chunk_seconds = chunkSeconds
+        self._dtype = numpy.dtype(dtype)
+        self._lock = threading.Lock()
+        self._chunk = -1               # number of the current chunk
+        self._wavelengths = None       # calibration of the current chunk
+        self._intensities = None
+        self._index = None
+        self._row = 0                  # next row in the current chunk
+        self._started = 0.0            # when the current chunk was started
+        self._frames = 0               # frames recorded so far
+        self._closed = False
+        os.makedirs(directory, exist_ok=True)
+        numbers = chunk_numbers(directory)
+        if len(numbers) > 0:
+            self._chunk = numbers[-1]
+
+    def directory(self):
+        return self._directory
+
+    def frames_recorded(self):
+        return self._frames
+
+    def _new_chunk(self, wavelengths):
+        self._close_chunk()
+        self._chunk += 1
+        wl_path, int_path, index_path = chunk_paths(self._directory,
+                                                    self._chunk)
+        numpy.save(wl_path, numpy.asarray(wavelengths, dtype=numpy.float64))
+        self._intensities = open_memmap(
+            int_path, mode='w+', dtype=self._dtype,
+            shape=(self._chunk_frames, len(wavelengths)))
+        self._index = open_memmap(index_path, mode='w+', dtype=INDEX_DTYPE,
+                                  shape=(self._chunk_frames,))
+        self._wavelengths = wavelengths
+        self._row = 0
+        self._started = time.time()
+
+    def _close_chunk(self):
+        if self._intensities is not None:
+            self._intensities.flush()
+            self._index.flush()
+        self._intensities = None
+        self._index = None
+
+    # called by the acquisition thread with every new frame
+    def record(self, frame):
+        with self._lock:
+            if self._closed:
+                return
+            if self._needs_new_chunk(frame):
+                self._new_chunk(frame.wavelengths)
+
+            row = self._row
+            settings = frame.settings or {}
+            self._intensities[row] = frame.intensities
+            entry = self._index[row:row + 1]
+            entry['timestamp'] = frame.timestamp
+            entry['integration_time'] = _number(
+                settings.get('integration-time-input'), numpy.nan)
+            entry['scans'] = _number(
+                settings.get('nscans-to-average-input'), 0)
+            entry['saturated'] = frame.saturated
+            mode, frames, boxcar = averaging_of(settings)
+            entry['averaging'] = mode.encode()
+            entry['averaged_frames'] = frames
+            entry['boxcar'] = boxcar
+            # written last; marks the row as complete
+            entry['seq'] = frame.seq
+            self._row += 1
+            self._frames += 1
+
+    def _needs_new_chunk(self, frame):
+        if self._intensities is None or self._row >= self._chunk_frames:
+            return True
+        if self._chunk_seconds is not None and \
+           frame.timestamp - self._started >= self._chunk_seconds:
+            return True
+        return (frame.wavelengths is not self._wavelengths and
+                not numpy.array_equal(frame.wavelengths, self._wavelengths))
+
+    # what is being recorded, for display
+    def status(self):
+        return {'directory': self._directory, 'frames': self._frames}
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._close_chunk()
+
+
+# read-only view of a recording; spectra stay on disk and are paged in
+# when they are used
+#
+# only rows that had been completely written when the reader was opened
+# are included, so a recording that is still running can be read; open
+# a new reader to see what was recorded since
+class RecordingReader:
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._chunks = []              # wavelengths, intensities, index
+        for number in chunk_numbers(directory):
+            wl_path, int_path, index_path = chunk_paths(directory, number)
+            index = numpy.load(index_path, mmap_mode='r')
+            rows = int(numpy.count_nonzero(index['seq'] > 0))
+            if rows == 0:
+                continue
+            self._chunks.append((numpy.load(wl_path),
+                                 numpy.load(int_path, mmap_mode='r')[:rows],
+                                 index[:rows]))
+        # position of the first frame of every chunk, and one past the end
+        self._starts = numpy.cumsum(
+            [0] + [len(chunk[2]) for chunk in self._chunks])
+        self._timestamps = numpy.concatenate(
+            [chunk[2]['timestamp'] for chunk in self._chunks] +
+            [numpy.empty(0)])
+
+    def directory(self):
+        return self._directory
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    # timestamps of all frames, in order
+    def timestamps(self):
+        return self._timestamps
+
+    # wavelengths, intensities and index row of the frame at position;
+    # frames of the same chunk share one wavelength array
+    def frame(self, position):
+        chunk = int(numpy.searchsorted(self._starts, position,
+                                       side='right')) - 1
+        wavelengths, intensities, index = self._chunks[chunk]
+        row = position - int(self._starts[chunk])
+        return wavelengths, intensities[row], index[row]
+
+    # position of the first frame taken at or after timestamp
+    def find(self, timestamp):
+        return int(numpy.searchsorted(self._timestamps, timestamp))
@@ -0,0 +1,638 @@
+import os
+import sys
+import json
+import time
+import threading
+import multiprocessing
+import concurrent.futures
+from multiprocessing.connection import Listener, Client
+
+import numpy
+
+import DashOceanOpticsSpectrometer as doos
+from DashOceanOpticsSpectrometer import DashOceanOpticsSpectrometer, DeviceInfo
+from acquisition import AcquisitionThread, Frame, spectrum_stats
+from peaks import PeakTracker
+from recording import SpectrumRecorder
+from waterfall import NO_ROWS, WaterfallHistory
+from worker import PRIORITY_SETTINGS
+
+# layout of the start of the shared file; everything is stored as float64
+_MAGIC = 0x0CEA0
+_HEADER = 8
+_CAPACITY = 1          # number of frame slots
+_PIXELS = 2            # length of every spectrum
+_LATEST = 3            # sequence number of the newest frame
+_LAST_READ = 4         # when a reader last asked for a frame
+_STATS = 5             # statistics stored per frame, see Frame.stats()
+_SETTINGS_WORDS = 64   # room for a frame's settings as JSON (x 8 bytes)
+
+
+def frames_path(directory):
+    return os.path.join(directory, 'frames.shm')
+
+
+def socket_path(directory):
+    return os.path.join(directory, 'control.sock')
+
+
+# control values as another process can have them; values that are
+# objects (e.g. a light source) are replaced by their repr, which is also
+# their label in DeviceInfo.light_sources
+def shareable_settings(settings):
+    if settings is None:
+        return None
+    return {ctrl_id: value
+            if value is None or isinstance(value, (bool, int, float, str))
+            else repr(value)
+            for ctrl_id, value in settings.items()}
+
+
+# ring buffer of frames in a memory-mapped file, written by the one
+# process that owns the spectrometer and read by any number of others
+# without copying; has the same interface as FrameRingBuffer, so that the
+# AcquisitionThread can publish straight into it
+#
+# the file holds a header, the wavelengths (stored once) and, for every
+# slot, a sequence number, a timestamp, the frame statistics, the
+# settings the frame was taken with (as JSON) and the intensities; a
+# slot's
+# sequence number is cleared while it is being written, so readers can
+# tell a complete frame from one in progress
+class SharedFrameRing:
+
+    def __init__(self, path, capacity=64, pollInterval=0.01,
+                 reopenInterval=1.0):
+        self._path = path
+        self._capacity = capacity
+        self._poll_interval = pollInterval      # when waiting (s)
+        self._reopen_interval = reopenInterval  # between file checks (s)
+        self._data = None
+        self._source_wavelengths = None         # last published calibration
+        self._inode = None
+        self._checked = 0.0
+        self._encoded_settings = (None, b'')    # last published, as JSON
+        self._decoded_settings = (b'', None)    # last read, as a dict
+
+    # writer side: (re)create the file for frames of these wavelengths;
+    # the file is only renamed into place once it is complete
+    def _create(self, wavelengths):
+        pixels = len(wavelengths)
+        capacity = self._capacity
+        size = (_HEADER + pixels +
+                (2 + _STATS + _SETTINGS_WORDS + pixels) * capacity)
+        last_read = self._header[_LAST_READ] if self._data is not None else 0
+
+        tmp = self._path + '.tmp'
+        data = numpy.memmap(tmp, dtype=numpy.float64, mode='w+',
+                            shape=(size,))
+        data[0] = _MAGIC
+        data[_CAPACITY] = capacity
+        data[_PIXELS] = pixels
+        data[_LAST_READ] = last_read
+        data[_HEADER:_HEADER + pixels] = wavelengths
+        data.flush()
+        os.rename(tmp, self._path)
+        self._inode = os.stat(self._path).st_ino
+        self._map(data)
+
+    # reader side: map the file, again if the writer has replaced it
+    def _attach(self):
+        now = time.time()
+        if self._data is not None and \
+           now - self._checked < self._reopen_interval:
+            return self._data is not None
+        self._checked = now
+        try:
+            inode = os.stat(self._path).st_ino
+            if inode != self._inode:
+                data = numpy.memmap(self._path, dtype=numpy.float64,
+                                    mode='r+')
+                if data[0] == _MAGIC:
+                    self._inode = inode
+                    self._map(data)
+        except (OSError, ValueError):
+            pass
+        return self._data is not None
+
+    def _map(self, data):
+        capacity = int(data[_CAPACITY])
+        pixels = int(data[_PIXELS])
+        offset = _HEADER
+        self._header = data[:_HEADER]
+        self._wavelengths = data[offset:offset + pixels]
+        self._wavelengths.flags.writeable = False
+        offset += pixels
+        self._slot_seq = data[offset:offset + capacity]
+        offset += capacity
+        self._timestamps = data[offset:offset + capacity]
+        offset += capacity
+        self._stats = data[offset:offset + capacity * _STATS].reshape(
+            capacity, _STATS)
+        offset += capacity * _STATS
+        self._settings = data[offset:offset + capacity * _SETTINGS_WORDS] \
+            .view(numpy.uint8).reshape(capacity, _SETTINGS_WORDS * 8)
+        offset += capacity * _SETTINGS_WORDS
+        self._intensities = data[offset:offset + capacity * pixels].reshape(
+            capacity, pixels)
+        self._capacity = capacity
+        self._data = data
+
+    # settings too long for their slot are not stored, and read as None
+    def _encode_settings(self, settings):
+        last, encoded = self._encoded_settings
+        if settings is last:
+            return encoded
+        encoded = b'' if settings is None else json.dumps(
+            shareable_settings(settings), separators=(',', ':')).encode()
+        if len(encoded) > _SETTINGS_WORDS * 8:
+            encoded = b''
+        self._encoded_settings = (settings, encoded)
+        return encoded
+
+    # the same dict for as long as the settings stay the same
+    def _decode_settings(self, raw):
+        encoded = raw.tobytes().rstrip(b'\0')
+        last, settings = self._decoded_settings
+        if encoded == last:
+            return settings
+        settings = json.loads(encoded.decode()) if encoded else None
+        self._decoded_settings = (encoded, settings)
+        return settings
+
+    def publish(self, timestamp, wavelengths, intensities, settings=None,
+                saturationLevel=None):
+        wavelengths = numpy.asarray(wavelengths)
+        intensities = numpy.asarray(intensities)
+        stats = spectrum_stats(wavelengths, intensities, saturationLevel)
+        # the calibration is normally the same array every frame
+        if wavelengths is not self._source_wavelengths:
+            if self._data is None or \
+               len(wavelengths) != len(self._wavelengths) or \
+               not numpy.array_equal(wavelengths, self._wavelengths):
+                self._create(wavelengths)
+            self._source_wavelengths = wavelengths
+
+        seq = int(self._header[_LATEST]) + 1
+        slot = seq % self._capacity
+        self._slot_seq[slot] = 0
+        self._timestamps[slot] = timestamp
+        self._stats[slot] = stats
+        encoded = self._encode_settings(settings)
+        self._settings[slot] = 0
+        self._settings[slot, :len(encoded)] = numpy.frombuffer(
+            encoded, dtype=numpy.uint8)
+        self._intensities[slot] = intensities
+        self._slot_seq[slot] = seq
+        self._header[_LATEST] = seq
+        # listeners in this process see the settings as they are
+        return Frame(seq, timestamp, self._wavelengths,
+                     self._intensities[slot], settings, stats)
+
+    # frame in the given slot, or None if it is being written; unless
+    # copied, the intensities are a view into shared memory that is only
+    # valid until the slot is reused, capacity frames later
+    def _frame(self, slot, copy=False):
+        seq = int(self._slot_seq[slot])
+        if seq <= 0:
+            return None
+        low, high, argmax, integral, saturated = self._stats[slot]
+        intensities = self._intensities[slot]
+        if copy:
+            intensities = intensities.copy()
+        settings = self._decode_settings(self._settings[slot])
+        frame = Frame(seq, float(self._timestamps[slot]), self._wavelengths,
+                      intensities, settings,
+                      (float(low), float(high), int(argmax), float(integral),
+                       bool(saturated)))
+        if int(self._slot_seq[slot]) != seq:
+            return None
+        return frame
+
+    def latest(self):
+        if not self._attach():
+            return None
+        seq = int(self._header[_LATEST])
+        if seq == 0:
+            return None
+        return self._frame(seq % self._capacity)
+
+    def latest_seq(self):
+        if not self._attach():
+            return 0
+        return int(self._header[_LATEST])
+
+    def wait_for_frame(self, seq, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while self.latest_seq() <= seq:
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(self._poll_interval)
+        return self.latest()
+
+    def frame_period(self, frames=8):
+        if not self._attach():
+            return None
+        timestamps = numpy.sort(self._timestamps[self._slot_seq > 0])
+        if len(timestamps) < 2:
+            return None
+        return float(numpy.median(numpy.diff(timestamps[-frames:])))
+
+    # oldest first; copied, since a snapshot may be kept (e.g. by an
+    # export that is still downloading) for longer than the ring takes to
+    # come round; a slot that was reused while it was copied is left out
+    def frames(self):
+        if not self._attach():
+            return []
+        order = numpy.argsort(self._slot_seq)
+        frames = [self._frame(slot, copy=True) for slot in order
+                  if self._slot_seq[slot] > 0]
+        return [f for f in frames if f is not None]
+
+    def touch(self):
+        if self._attach():
+            self._header[_LAST_READ] = time.time()
+
+    # the writer treats a ring that does not exist yet as in demand, so
+    # that the first frame creates it
+    def wait_for_demand(self, idleTimeout, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self._data is None or \
+               time.time() - self._header[_LAST_READ] < idleTimeout:
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(min(self._poll_interval * 10, idleTimeout))
+
+    def capacity(self):
+        return self._capacity
+
+    def __len__(self):
+        if not self._attach():
+            return 0
+        return int(numpy.count_nonzero(self._slot_seq > 0))
+
+
+# runs in the process that owns the spectrometer: acquires frames into
+# the shared ring and carries out commands sent by the web workers over
+# a unix socket
+class AcquisitionServer:
+
+    def __init__(self, spec, directory, authkey, bufferSize=64):
+        self._spec = spec
+        self._directory = directory
+        self._authkey = authkey
+        self._ring = SharedFrameRing(frames_path(directory), bufferSize)
+        self._acquisition = AcquisitionThread(spec, self._ring)
+        self._recorder = None
+        self._waterfall = None
+        self._peak_tracker = None
+        self._lock = threading.Lock()     # requests come on many threads
+
+    def serve_forever(self):
+        self._acquisition.start()
+        listener = Listener(socket_path(self._directory), family='AF_UNIX',
+                            authkey=self._authkey)
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception:
+                continue
+            threading.Thread(target=self._handle, args=(conn,),
+                             daemon=True).start()
+
+    # one web worker; requests are (method, args) and replies are
+    # ('ok', result) or ('error', message)
+    def _handle(self, conn):
+        while True:
+            try:
+                method, args = conn.recv()
+            except (EOFError, OSError):
+                conn.close()
+                return
+            try:
+                reply = ('ok', self._dispatch(method, args))
+            except Exception as e:
+                reply = ('error', str(e))
+            try:
+                conn.send(reply)
+            except OSError:
+                return
+
+    def _dispatch(self, method, args):
+        if method == 'device_info':
+            return self._shareable_info()
+        elif method == 'send_control_values':
+            commands = dict(args[0])
+            if 'light-source-input' in commands:
+                commands['light-source-input'] = self._light_source(
+                    commands['light-source-input'])
+            return self._spec.send_control_values(commands)
+        elif method == 'send_light_intensity':
+            return self._spec.send_light_intensity(
+                self._light_source(args[0]), args[1])
+        elif method == 'disconnect':
+            return self._spec.disconnect()
+        elif method == 'start_recording':
+            return self._start_recording(*args)
+        elif method == 'stop_recording':
+            return self._stop_recording()
+        elif method == 'recording_status':
+            recorder = self._recorder
+            return None if recorder is None else recorder.status()
+        elif method == 'device_health':
+            return self._spec.health()
+        elif method == 'settings':
+            return shareable_settings(self._spec.settings())
+        elif method == 'start_waterfall':
+            return self._start_waterfall(*args)
+        elif method == 'waterfall_rows':
+            waterfall = self._waterfall
+            return NO_ROWS if waterfall is None else waterfall.rows(*args)
+        elif method == 'waterfall_generation':
+            waterfall = self._waterfall
+            return (NO_ROWS[0] if waterfall is None else
+                    waterfall.generation())
+        elif method == 'start_peak_tracking':
+            return self._start_peak_tracking(*args)
+        elif method == 'band_series':
+            tracker = self._peak_tracker
+            if tracker is None:
+                return numpy.empty(0), {}
+            return tracker.series(*args)
+        elif method == 'latest_bands':
+            tracker = self._peak_tracker
+            return None if tracker is None else tracker.latest()
+        elif method == 'delivery_update':
+            return self._spec.delivery_tracker().update(*args)
+        raise ValueError('unknown command %s' % method)
+
+    # frames are recorded here, where they are acquired, so that the
+    # recording never waits on a web worker
+    def _start_recording(self, directory, chunkFrames, chunkSeconds):
+        self._stop_recording()
+        self._recorder = SpectrumRecorder(directory, chunkFrames,
+                                          chunkSeconds)
+        self._acquisition.add_listener(self._recorder.record)
+
+    # like the recording, the waterfall is built here, from every frame;
+    # the first web worker to ask starts it
+    def _start_waterfall(self, rows, columns, rowPeriod):
+        with self._lock:
+            if self._waterfall is not None:
+                return
+            self._waterfall = WaterfallHistory(rows, columns, rowPeriod)
+            self._acquisition.add_listener(self._waterfall.add,
+                                           keepRunning=False)
+
+    def _start_peak_tracking(self, bands, history):
+        with self._lock:
+            if self._peak_tracker is not None:
+                return
+            self._peak_tracker = PeakTracker(bands, history)
+            self._acquisition.add_listener(self._peak_tracker.add,
+                                           keepRunning=False)
+
+    def _stop_recording(self):
+        recorder, self._recorder = self._recorder, None
+        if recorder is not None:
+            self._acquisition.remove_listener(recorder.record)
+            recorder.close()
+
+    # device properties that can be sent to another process; light
+    # sources that are device objects are replaced by their labels
+    def _shareable_info(self):
+        info = self._spec.device_info()
+        if info is None:
+            return None
+        return DeviceInfo(
+            model=info.model,
+            serial=info.serial,
+            pixels=info.pixels,
+            wavelengths=info.wavelengths,
+            lightSources=[{'label': ls['label'],
+                           'value': ls['value']
+                           if isinstance(ls['value'], str) else ls['label']}
+                          for ls in info.light_sources],
+            intTimeMin=info.int_time_min,
+            intTimeMax=info.int_time_max,
+            maxIntensity=info.max_intensity
+        )
+
+    # the device's light source for a value chosen in a web worker
+    def _light_source(self, value):
+        for ls in self._spec.light_sources():
+            if ls['label'] == value and not isinstance(ls['value'], str):
+                return ls['value']
+        return value
+
+
+# spectrometer in a web worker that reads frames from the shared ring
+# and forwards commands to the acquisition process; requests go through
+# the device thread, which also keeps the connection from being used by
+# two callbacks at once
+class RemoteSpectrometer(DashOceanOpticsSpectrometer):
+
+    def __init__(self, directory, authkey, commandTimeout=15,
+                 connectTimeout=10):
+        super().__init__(commandTimeout)
+        self._address = socket_path(directory)
+        self._authkey = authkey
+        self._conn = None
+        self._frames = SharedFrameRing(frames_path(directory))
+
+        # the acquisition process may still be starting up
+        deadline = time.time() + connectTimeout
+        while True:
+            try:
+                self._device_call(PRIORITY_SETTINGS, self._connect)
+                break
+            except Exception:
+                if time.time() >= deadline:
+                    break
+                time.sleep(0.2)
+
+    def _request(self, method, *args):
+        try:
+            if self._conn is None:
+                self._conn = Client(self._address, family='AF_UNIX',
+                                    authkey=self._authkey)
+            self._conn.send((method, args))
+            status, value = self._conn.recv()
+        except (EOFError, OSError):
+            self._conn = None
+            raise
+        if status == 'error':
+            raise Exception(value)
+        return value
+
+    def _connect(self):
+        self._device_info = self._request('device_info')
+
+    def _assign_spec(self):
+        if self._device_info is not None:
+            return
+        try:
+            self._connect()
+        except Exception as e:
+            self._health.failure(e)
+
+    def _disconnect(self):
+        self._device_info = None
+        self._request('disconnect')
+
+    def _read_spectrum(self):
+        frame = self.latest_frame()
+        if frame is None:
+            return None
+        return [frame.wavelengths, frame.intensities]
+
+    # the acquisition process knows what was last applied, and applies
+    # the averaging and exposure controls itself, so every command is
+    # sent there as it is
+    def send_control_values(self, commands):
+        try:
+            failed, succeeded, timings = self._device_call(
+                PRIORITY_SETTINGS, self._request, 'send_control_values',
+                commands)
+        except concurrent.futures.TimeoutError:
+            self._health.command_failure(
+                'timed out waiting for the acquisition process')
+            return ({ctrl_id: 'timed out waiting for the spectrometer'
+                     for ctrl_id in commands}, {},
+                    {ctrl_id: self._command_timeout for ctrl_id in commands})
+
+        if len(succeeded) > 0:
+            settings = dict(self._settings)
+            settings.update({ctrl_id: commands[ctrl_id]
+                             for ctrl_id in succeeded})
+            self._settings = settings
+        return (failed, succeeded, timings)
+
+    def _send_light_intensity(self, lightSource, intensity):
+        self._request('send_light_intensity', lightSource, intensity)
+
+    # frames are acquired by the acquisition process
+    def start_acquisition(self, bufferSize, dtype=None):
+        return
+
+    def acquiring(self):
+        return True
+
+    def start_recording(self, directory, chunkFrames=1000,
+                        chunkSeconds=None):
+        self._device_call(PRIORITY_SETTINGS, self._request,
+                          'start_recording', directory, chunkFrames,
+                          chunkSeconds)
+
+    def stop_recording(self):
+        self._device_call(PRIORITY_SETTINGS, self._request, 'stop_recording')
+
+    def recording_status(self):
+        return self._device_call(PRIORITY_SETTINGS, self._request,
+                                 'recording_status')
+
+    def start_waterfall(self, rows, columns, rowPeriod):
+        self._device_call(PRIORITY_SETTINGS, self._request,
+                          'start_waterfall', rows, columns, rowPeriod)
+
+    def waterfall_rows(self, after=None):
+        return self._device_call(PRIORITY_SETTINGS, self._request,
+                                 'waterfall_rows', after)
+
+    def waterfall_generation(self):
+        return self._device_call(PRIORITY_SETTINGS, self._request,
+                                 'waterfall_generation')
+
+    def start_peak_tracking(self, bands, history):
+        self._device_call(PRIORITY_SETTINGS, self._request,
+                          'start_peak_tracking', bands, history)
+
+    def band_series(self, since=None):
+        return self._device_call(PRIORITY_SETTINGS, self._request,
+                                 'band_series', since)
+
+    def latest_bands(self):
+        return self._device_call(PRIORITY_SETTINGS, self._request,
+                                 'latest_bands')
+
+    # what the acquisition process last applied, including what other web
+    # workers and auto exposure changed; only this worker's own changes
+    # if it cannot be asked
+    def settings(self):
+        try:
+            return self._device_call(PRIORITY_SETTINGS, self._request,
+                                     'settings')
+        except Exception:
+            return self._settings
+
+    # kept by the acquisition process, so that it is shared by all web
+    # workers
+    def delivery_tracker(self):
+        return RemoteDeliveryTracker(self)
+
+    # the device is read by the acquisition process, so its health is
+    # kept there; this process's own record only says that the
+    # acquisition process could not be asked
+    def health(self):
+        try:
+            return self._device_call(PRIORITY_SETTINGS, self._request,
+                                     'device_health')
+        except concurrent.futures.TimeoutError:
+            self._health.failure('timed out waiting for the acquisition '
+                                 'process')
+        except Exception as e:
+            self._health.failure(e)
+        return self._health.snapshot()
+
+
+# FrameDeliveryTracker of the acquisition process, used by the web
+# workers in its place; if the acquisition process cannot be asked, the
+# update is sent rather than wrongly skipped
+class RemoteDeliveryTracker:
+
+    def __init__(self, spec):
+        self._spec = spec
+
+    def update(self, clientId, state):
+        try:
+            return self._spec._device_call(PRIORITY_SETTINGS,
+                                           self._spec._request,
+                                           'delivery_update', clientId,
+                                           state)
+        except Exception:
+            return True
+
+
+# replay is the directory of a recording to play back instead of using a
+# spectrometer
+def serve(directory, authkey, demo=False, bufferSize=64, replay=None,
+          replaySpeed=1.0):
+    if replay is not None:
+        spec = doos.ReplaySpectrometer(replay, replaySpeed)
+    elif demo:
+        spec = doos.DemoSpectrometer()
+    else:
+        spec = doos.PhysicalSpectrometer()
+    AcquisitionServer(spec, directory, authkey, bufferSize).serve_forever()
+
+
+# start the acquisition process; web workers then connect to it with
+# RemoteSpectrometer(directory, authkey)
+def start_acquisition_process(directory, authkey, demo=False, bufferSize=64,
+                              replay=None, replaySpeed=1.0):
+    process = multiprocessing.Process(
+        target=serve,
+        args=(directory, authkey, demo, bufferSize, replay, replaySpeed),
+        name='spectrometer-acquisition', daemon=True
+    )
+    process.start()
+    return process
+
+
+# run the acquisition process on its own:
+#     SPECTROMETER_AUTHKEY=<hex> python sharedacquisition.py <dir> [demo]
+if __name__ == '__main__':
+    serve(sys.argv[1], bytes.fromhex(os.environ['SPECTROMETER_AUTHKEY']),
+          len(sys.argv) == 3 and sys.argv[2] == "demo")
@@ -0,0 +1,142 @@
+import json
+import time
+import base64
+import struct
+
+import flask
+import numpy
+
+# binary stream messages are this header followed by count little-endian
+# float32 values: the wavelengths for a calibration message, the
+# intensities for a frame message
+#     magic b'SPEC', kind, sequence number, timestamp, count
+MESSAGE_HEADER = struct.Struct('<4sBQdI')
+MAGIC = b'SPEC'
+KIND_CALIBRATION = 0
+KIND_FRAME = 1
+
+# longest time a stream waits without sending anything (s)
+KEEPALIVE_INTERVAL = 15
+
+
+def _float32(values):
+    return numpy.asarray(values, dtype='<f4').tobytes()
+
+
+# yields (calibration, frame) for every new frame as soon as it has been
+# acquired, and (None, None) when nothing arrived for a while; the
+# calibration is only given with the first frame and whenever it changes,
+# and frames are skipped rather than queued if the client is slower than
+# maxRate (frames per second) or than the spectrometer
+def _new_frames(spec, maxRate=None):
+    seq = 0
+    wavelengths = None
+    min_period = 1.0 / maxRate if maxRate else 0.0
+    sent = 0.0
+    waited = 0.0
+
+    while True:
+        # wait in short steps, each of which keeps acquisition running
+        frame = spec.wait_for_frame(seq, 1.0)
+        if frame is None:
+            waited += 1.0
+            if waited >= KEEPALIVE_INTERVAL:
+                waited = 0.0
+                yield None, None
+            continue
+        waited = 0.0
+
+        calibration = None
+        if frame.wavelengths is not wavelengths and \
+           (wavelengths is None or
+            not numpy.array_equal(frame.wavelengths, wavelengths)):
+            calibration = frame.wavelengths
+        wavelengths = frame.wavelengths
+        seq = frame.seq
+
+        yield calibration, frame
+
+        if min_period:
+            delay = sent + min_period - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            sent = time.time()
+
+
+def _sse(event, payload):
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(payload))
+
+
+# server-sent events: a 'calibration' event with the base64-encoded
+# float32 wavelengths, then a 'frame' event per spectrum with its
+# statistics and base64-encoded float32 intensities
+def _event_stream(spec, maxRate):
+    for calibration, frame in _new_frames(spec, maxRate):
+        if frame is None:
+            yield ': keepalive\n\n'
+            continue
+        if calibration is not None:
+            yield _sse('calibration', {
+                'wavelengths': base64.b64encode(
+                    _float32(calibration)).decode()
+            })
+        yield _sse('frame', {
+            'seq': frame.seq,
+            'timestamp': frame.timestamp,
+            'min': frame.min,
+            'max': frame.max,
+            'saturated': frame.saturated,
+            'intensities': base64.b64encode(
+                _float32(frame.intensities)).decode()
+        })
+
+
+# raw binary messages, see MESSAGE_HEADER
+def _binary_stream(spec, maxRate):
+    for calibration, frame in _new_frames(spec, maxRate):
+        if frame is None:
+            # an empty calibration message keeps the connection alive
+            yield MESSAGE_HEADER.pack(MAGIC, KIND_CALIBRATION, 0, 0.0, 0)
+            continue
+        if calibration is not None:
+            yield MESSAGE_HEADER.pack(MAGIC, KIND_CALIBRATION, frame.seq,
+                                      frame.timestamp, len(calibration))
+            yield _float32(calibration)
+        yield MESSAGE_HEADER.pack(MAGIC, KIND_FRAME, frame.seq,
+                                  frame.timestamp, len(frame.intensities))
+        yield _float32(frame.intensities)
+
+
+# routes that push spectra to clients as they are acquired:
+#     /stream/spectra       server-sent events, for browsers
+#     /stream/spectra.bin   binary messages, for analysis scripts
+# both take an optional max_rate query parameter (frames per second)
+def streaming_blueprint(spec):
+    blueprint = flask.Blueprint('streaming', __name__)
+
+    def max_rate():
+        return flask.request.args.get('max_rate', default=None, type=float)
+
+    @blueprint.route('/stream/spectra')
+    def stream_events():
+        return flask.Response(
+            _event_stream(spec, max_rate()),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
+    @blueprint.route('/stream/spectra.bin')
+    def stream_binary():
+        return flask.Response(
+            _binary_stream(spec, max_rate()),
+            mimetype='application/octet-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
+    return blueprint
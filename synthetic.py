@@ -0,0 +1,82 @@
+import numpy
+
+
+# a gaussian feature of a synthetic spectrum; width is the distance (nm)
+# from the centre at which the peak falls to 1/e of its height
+class Peak:
+    def __init__(self, center, width, height=1.0):
+        self.center = center
+        self.width = width
+        self.height = height
+
+
+# generates whole synthetic spectra at once with numpy
+#
+# each spectrum is
+#     scale * (profile + uniformNoise * U[0, 1)) + offset
+#     + shot noise + read noise
+# where the profile is the sum of the peaks and a baseline polynomial
+# (coefficients highest order first, in wavelength normalised to [0, 1]);
+# shot noise is gaussian with a standard deviation of
+# shotNoise * sqrt(counts), read noise is gaussian with a standard
+# deviation of readNoise counts
+class SyntheticSpectrum:
+
+    def __init__(self, pixels=5000, wavelengthRange=(400, 900), peaks=None,
+                 baseline=None, uniformNoise=0.01, shotNoise=0.0,
+                 readNoise=0.0, seed=None):
+        self._wavelengths = numpy.linspace(wavelengthRange[0],
+                                           wavelengthRange[1], pixels)
+        self._peaks = [Peak(500, 5)] if peaks is None else list(peaks)
+        self._baseline = [] if baseline is None else list(baseline)
+        self.uniform_noise = uniformNoise
+        self.shot_noise = shotNoise
+        self.read_noise = readNoise
+        self._rng = numpy.random.RandomState(seed)
+        self._profile = self._compute_profile()
+
+    # noiseless shape of the spectrum; only recomputed when peaks or the
+    # baseline change
+    def _compute_profile(self):
+        wl = self._wavelengths
+        profile = numpy.zeros_like(wl)
+        for peak in self._peaks:
+            profile += peak.height * numpy.exp(-((wl - peak.center) /
+                                                 peak.width)**2)
+        if len(self._baseline) > 0:
+            span = wl[-1] - wl[0] if len(wl) > 1 else 1.0
+            profile += numpy.polyval(self._baseline, (wl - wl[0]) / span)
+        return profile
+
+    def set_peaks(self, peaks):
+        self._peaks = list(peaks)
+        self._profile = self._compute_profile()
+
+    def set_baseline(self, coefficients):
+        self._baseline = list(coefficients)
+        self._profile = self._compute_profile()
+
+    def seed(self, seed):
+        self._rng.seed(seed)
+
+    def pixels(self):
+        return len(self._wavelengths)
+
+    def wavelengths(self):
+        return self._wavelengths
+
+    # one spectrum; scale multiplies the profile (the demo uses the
+    # integration time) and offset is added to every pixel
+    def intensities(self, scale=1.0, offset=0.0):
+        n = len(self._wavelengths)
+        counts = self._profile.copy()
+        if self.uniform_noise:
+            counts += self.uniform_noise * self._rng.random_sample(n)
+        counts *= scale
+        counts += offset
+        if self.shot_noise:
+            counts += (self.shot_noise * numpy.sqrt(numpy.abs(counts)) *
+                       self._rng.standard_normal(n))
+        if self.read_noise:
+            counts += self.read_noise * self._rng.standard_normal(n)
+        return counts
@@ -0,0 +1,216 @@
+import json
+import time
+import threading
+
+import numpy
+
+from figures import RawJSON, dumps, encode_floats
+
+# rows of a waterfall that does not exist yet
+NO_ROWS = (0, None, [])
+
+# rows sent to a page that has not been sent any yet, in case they were
+# completed after the figure it was sent
+CATCH_UP_ROWS = 10
+
+
+# time versus wavelength history of the spectrum, at screen resolution
+#
+# every frame is reduced to columns wavelength bins (the mean of the
+# pixels in each) and the frames of each rowPeriod seconds are averaged
+# into one row; rows are kept in a preallocated rows x columns ring, so
+# memory stays fixed however long the app runs
+#
+# frames are added by the acquisition thread (see add), in the process
+# that acquires them, so that every frame is included and every web
+# worker sees the same history; rows are placed by time (the timestamp
+# divided by rowPeriod), and periods without frames are left empty
+class WaterfallHistory:
+
+    def __init__(self, rows=300, columns=500, rowPeriod=1.0):
+        self._rows = rows
+        self._columns = columns
+        self._row_period = rowPeriod
+        self._lock = threading.Lock()
+        self._matrix = numpy.full((rows, columns), numpy.nan,
+                                  dtype=numpy.float32)
+        self._indices = numpy.full(rows, -1)  # time index of each row
+        self._sums = numpy.zeros(columns)     # row being accumulated
+        self._count = 0                       # frames in it
+        self._current = None                  # its time index
+        self._newest = None                   # time index of the newest row
+        self._oldest = None                   # and of the first one
+        self._generation = 0                  # changes with the calibration
+        # calibration, first pixel of every bin, pixels per bin, and the
+        # bin centres
+        self._bins = (None, None, None, None)
+
+    # bytes taken by the matrix
+    def nbytes(self):
+        return self._matrix.nbytes
+
+    # changes whenever the history starts again (for a new calibration),
+    # so a whole figure only needs sending when it has; rows added in
+    # between can be appended to the figure
+    def generation(self):
+        return self._generation
+
+    def _binning(self, wavelengths):
+        calibration, starts, counts, _ = self._bins
+        if wavelengths is calibration:
+            return starts, counts
+        if calibration is not None and \
+           numpy.array_equal(wavelengths, calibration):
+            self._bins = (wavelengths,) + self._bins[1:]
+            return starts, counts
+
+        # a new calibration; the history no longer matches it
+        self._clear()
+        pixels = len(wavelengths)
+        columns = min(self._columns, pixels)
+        starts = numpy.linspace(0, pixels, columns + 1).astype(int)[:-1]
+        counts = numpy.diff(numpy.append(starts, pixels))
+        centres = numpy.add.reduceat(
+            numpy.asarray(wavelengths, dtype=numpy.float64), starts) / counts
+        self._bins = (wavelengths, starts, counts, centres)
+        return starts, counts
+
+    def _clear(self):
+        self._matrix[:] = numpy.nan
+        self._indices[:] = -1
+        self._sums[:] = 0
+        self._count = 0
+        self._current = None
+        self._newest = None
+        self._oldest = None
+        self._generation += 1
+
+    # add a newly acquired frame; called by the acquisition thread
+    def add(self, frame):
+        with self._lock:
+            starts, counts = self._binning(frame.wavelengths)
+            index = int(frame.timestamp // self._row_period)
+            if self._current is not None and index != self._current:
+                self._finish_row()
+            self._current = index
+            self._sums[:len(starts)] += numpy.add.reduceat(
+                frame.intensities, starts) / counts
+            self._count += 1
+
+    def _finish_row(self):
+        index = self._current
+        slot = index % self._rows
+        row = self._matrix[slot]
+        row[:] = numpy.nan
+        columns = len(self._bins[1])
+        row[:columns] = self._sums[:columns] / self._count
+        self._indices[slot] = index
+        self._newest = index
+        if self._oldest is None:
+            self._oldest = index
+        self._sums[:] = 0
+        self._count = 0
+
+    # the generation, the bin centres and the complete rows newer than
+    # the time index after (all of them if None), oldest first, as (time
+    # index, row); the row is None for periods without frames
+    def rows(self, after=None):
+        with self._lock:
+            if self._newest is None:
+                return (self._generation, self._bins[3], [])
+            columns = len(self._bins[1])
+            first = max(self._newest - self._rows + 1, self._oldest)
+            if after is not None:
+                first = max(first, after + 1)
+            rows = []
+            for index in range(first, self._newest + 1):
+                slot = index % self._rows
+                rows.append((index, self._matrix[slot, :columns].copy()
+                             if self._indices[slot] == index else None))
+            return (self._generation, self._bins[3], rows)
+
+
+# local time at which the row with the given time index starts, as
+# plotly reads dates
+def row_time(index, rowPeriod):
+    start = index * rowPeriod
+    return '%s.%03d' % (time.strftime('%Y-%m-%d %H:%M:%S',
+                                      time.localtime(start)),
+                        int(round(start % 1 * 1000)) % 1000)
+
+
+def _encoded_row(row, columns, precision):
+    if row is None:
+        row = numpy.full(columns, numpy.nan)
+    return encode_floats(row, precision)
+
+
+# encoded heatmap of rows (as returned by WaterfallHistory.rows), newest
+# at the top; rows completed later are appended in the browser, see
+# assets/waterfall.js
+def waterfall_figure(rows, rowPeriod, colors, precision=4):
+    _, centres, rows = rows
+    columns = 0 if centres is None else len(centres)
+    trace = {
+        'type': 'heatmap',
+        'colorscale': 'Viridis',
+        'colorbar': {
+            'tickfont': {
+                'color': colors['tertiary']
+            }
+        },
+        'x': RawJSON('[]' if centres is None else
+                     encode_floats(centres)),
+        'y': [row_time(index, rowPeriod) for index, _ in rows],
+        'z': RawJSON('[' + ','.join(_encoded_row(row, columns, precision)
+                                    for _, row in rows) + ']')
+    }
+    layout = {
+        'height': 400,
+        'font': {
+            'family': 'Helvetica Neue, sans-serif',
+            'size': 12
+        },
+        'margin': {
+            't': 20
+        },
+        'xaxis': {
+            'title': 'Wavelength (nm)',
+            'color': colors['secondary']
+        },
+        'yaxis': {
+            'title': 'Time',
+            'type': 'date',
+            'color': colors['secondary']
+        },
+        'paper_bgcolor': colors['background'],
+        'plot_bgcolor': colors['background']
+    }
+    return RawJSON(dumps({'data': [trace], 'layout': layout}))
+
+
+# JSON for assets/waterfall.js, which appends the rows to the plot: the
+# generation and the rows (as returned by WaterfallHistory.rows) with
+# their times ('t') and values ('z'), the number of rows the plot keeps
+# ('keep'), and the time index of the last row ('last')
+def waterfall_rows_json(rows, keep, rowPeriod, precision=4):
+    generation, centres, rows = rows
+    columns = 0 if centres is None else len(centres)
+    return '{"generation":%d,"last":%d,"keep":%d,"rows":[%s]}' % (
+        generation, rows[-1][0], keep, ','.join(
+            '{"t":"%s","z":%s}' % (row_time(index, rowPeriod),
+                                   _encoded_row(row, columns, precision))
+            for index, row in rows))
+
+
+# rows completed since the ones in sent (a waterfall_rows_json payload,
+# or None), or the last CATCH_UP_ROWS if the page has not been sent any
+# of this generation; the figure it was sent has the ones before
+def new_waterfall_rows(spec, sent):
+    if sent:
+        sent = json.loads(sent)
+        rows = spec.waterfall_rows(sent['last'])
+        if rows[0] == sent['generation']:
+            return rows
+    generation, centres, rows = spec.waterfall_rows()
+    return (generation, centres, rows[-CATCH_UP_ROWS:])
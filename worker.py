@@ -0,0 +1,106 @@
+import itertools
+import queue
+import threading
+import time
+import concurrent.futures
+
+# order in which queued work is done; lower numbers first, and work of
+# the same priority in the order it was submitted
+PRIORITY_SETTINGS = 0
+PRIORITY_LIGHT = 1
+PRIORITY_ACQUISITION = 2
+
+_STOP = -1
+
+
+# the one thread allowed to talk to a spectrometer; every piece of
+# hardware I/O is submitted to it and done one at a time, so callers
+# never need locks and a settings change never waits behind more than
+# the read that is already in progress
+class DeviceWorker(threading.Thread):
+
+    def __init__(self, name='spectrometer-device'):
+        super().__init__(name=name, daemon=True)
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+
+    # queue func(*args) to run on the device thread; returns a Future
+    # holding its result or exception
+    def submit(self, priority, func, *args):
+        future = concurrent.futures.Future()
+        self._queue.put((priority, next(self._order), future, func, args))
+        return future
+
+    # run func(*args) on the device thread and wait at most timeout
+    # seconds (None waits forever) for its result; on timeout the work is
+    # cancelled if it has not started yet, and
+    # concurrent.futures.TimeoutError is raised
+    def call(self, priority, timeout, func, *args):
+        # already on the device thread; waiting on the queue would deadlock
+        if threading.current_thread() is self:
+            return func(*args)
+
+        future = self.submit(priority, func, *args)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def run(self):
+        while True:
+            priority, _, future, func, args = self._queue.get()
+            if priority == _STOP:
+                if func is not None:
+                    func(*args)
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    # finish the work in progress and stop; queued work is not run, but
+    # cleanup(*args) is, on the device thread, if given
+    def stop(self, timeout=None, cleanup=None, *args):
+        self._queue.put((_STOP, next(self._order), None, cleanup, args))
+        self.join(timeout)
+
+
+# keeps only the latest value put for each key and hands them to
+# apply(key, value) on its own thread, at most once every minInterval
+# seconds; put() never waits, so a value that changes quickly (e.g. a
+# knob being dragged) only reaches the device as often as it can usefully
+# be applied, and always ends on the last value
+class CoalescingQueue(threading.Thread):
+
+    def __init__(self, apply, minInterval=0.05, name='coalescing-queue'):
+        super().__init__(name=name, daemon=True)
+        self._apply = apply
+        self._min_interval = minInterval
+        self._cond = threading.Condition()
+        self._pending = {}
+
+    def put(self, key, value):
+        with self._cond:
+            self._pending[key] = value
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._pending) > 0)
+                pending = self._pending
+                self._pending = {}
+            started = time.time()
+            for key, value in pending.items():
+                # a value that could not be applied is dropped; the next
+                # one is tried afresh
+                try:
+                    self._apply(key, value)
+                except Exception:
+                    pass
+            delay = started + self._min_interval - time.time()
+            if delay > 0:
+                time.sleep(delay)